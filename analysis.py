@@ -1,71 +1,192 @@
+import warnings
 import numpy as np
+from scipy import stats
 import util
-from scipy import signal, interpolate
+import parallel
+from profiling import instrument
 
 
 ##########---------------------------Heart Rate-------------------------------##############
-def samplingFq_vs_HR(original_hr, original_fq, target_HRs, resampled_rates):
+def _fq_cell(shared, idx, original_fq, new_fq, target_HRs, exhaustive, stopping):
+    if new_fq is None:
+        #  synthesize data for each target HR with same temporal duration
+        synth_hr = util.synth_HR_batch(shared['original_hr'], original_fq, target_HRs);
+        return get_hr_distribution(synth_hr, original_fq, exhaustive, stopping)
+
+    hr_signal_resampled = shared['resampled'][idx,:shared['lengths'][idx]]
+    hr_synth_resampled = util.synth_HR_batch(hr_signal_resampled, new_fq, target_HRs); # 1 min synth data for each target HR
+    return get_hr_distribution(hr_synth_resampled, new_fq, exhaustive, stopping)
+
+
+@instrument
+def samplingFq_vs_HR(original_hr, original_fq, target_HRs, resampled_rates, exhaustive = False, num_workers = None, seed = None, store = None, stopping = None):
     '''
     Determine how changing the sampling frequency impacts error in calculating heart rate across heart rate amplitude
+    With num_workers the sampling frequencies are spread over a process pool (see parallel.run_cells), reproducible from seed.
+    With a store (sweepstore.SweepStore) only the sampling frequencies not computed before are run.
+    stopping (dict, see _draw_until_converged): sequential mode of get_hr_distribution; the iterations used and the
+    achieved confidence interval widths (HR targets x rates) are returned last.
     '''
-    
-    
-    #  synthesize data for each target HR with same temporal duration
-    synth_hr = util.synth_HR(original_hr, original_fq, target_HRs);
+    _check_stopping(exhaustive, stopping)
     
     # there will be some error between the 'target' heart rate of synthetic data and what can be estimated due to the discrete nature of peak counting
     # Thus, Use this estimated HR (rather than target HR) as a benchmark for good performance
-    estim_HRs, estim_std = get_hr_distribution(synth_hr, original_fq)
+    # (first cell: no resampling)
+    cells = [(None, original_fq, None, target_HRs, exhaustive, stopping)]
+    cells += [(idx, original_fq, new_fq, target_HRs, exhaustive, stopping) for idx, new_fq in enumerate(resampled_rates)]
+    resampled, lengths = util.resample_hr_batch(original_hr, original_fq, resampled_rates) # all rates in one call
+    shared = dict(original_hr = np.asarray(original_hr), resampled = resampled, lengths = lengths)
+    keys = None
+    if store is not None:
+        # a cell is determined by the original signal and its parameters, not by its position in resampled_rates
+        fingerprint = store.fingerprint(dict(original_hr = shared['original_hr']))
+        keys = [(fingerprint,) + cell[1:] for cell in cells]
+    cell_results = parallel.run_cells(_fq_cell, cells, shared, num_workers, seed, store, keys)
+    return _hr_sweep_results(cell_results, target_HRs, resampled_rates, 'resampled_rates', stopping, store, 'samplingFq_vs_HR')
+
+
+def _hr_sweep_results(cell_results, target_HRs, values, name, stopping, store, sweep):
+    # (target HRs x values) arrays from the cells of samplingFq_vs_HR/samplingDur_vs_HR; the first cell is the baseline
+    estim_HRs = cell_results[0][0]
     
-    results_means = np.zeros((len(target_HRs), len(resampled_rates)))
-    results_error = np.zeros((len(target_HRs), len(resampled_rates)))
-    results_stds = np.zeros((len(target_HRs), len(resampled_rates)))
+    results_means = np.zeros((len(target_HRs), len(values)))
+    results_error = np.zeros((len(target_HRs), len(values)))
+    results_stds = np.zeros((len(target_HRs), len(values)))
+    results_iterations = np.zeros((len(target_HRs), len(values)), dtype=int)
+    results_ci = np.zeros((len(target_HRs), len(values)))
     
-    for idx, new_fq in enumerate(resampled_rates):
-        hr_signal_resampled = util.resample_hr(original_hr, original_fq, new_fq)
-        hr_synth_resampled = util.synth_HR(hr_signal_resampled, new_fq, target_HRs); # 1 min synth data for each target HR
-
-        estim_HRs_resampled, estim_std_resampled = get_hr_distribution(hr_synth_resampled, new_fq)
-        results_means[:,idx] = estim_HRs_resampled
-        results_stds[:,idx] = estim_std_resampled
-        results_error[:,idx] = np.abs(np.subtract(estim_HRs, estim_HRs_resampled))
+    for idx, cell_result in enumerate(cell_results[1:]):
+        results_means[:,idx] = cell_result[0]
+        results_stds[:,idx] = cell_result[1]
+        results_error[:,idx] = np.abs(np.subtract(estim_HRs, cell_result[0]))
+        if stopping is not None:
+            results_iterations[:,idx] = cell_result[2]
+            results_ci[:,idx] = cell_result[3]
     
+    results = dict(results_error = results_error, results_means = results_means, results_stds = results_stds)
+    if stopping is not None:
+        results.update(results_iterations = results_iterations, results_ci = results_ci)
+    if store is not None:
+        store.save_grid(sweep, {'target_HRs': target_HRs, name: values}, results)
+    if stopping is not None:
+        return results_error, results_means, results_stds, results_iterations, results_ci
     return results_error, results_means, results_stds
     
     
     
-def samplingDur_vs_HR(original_hr, fq, target_HRs, sample_durs):
+def _dur_cell(shared, fq, dur, exhaustive, stopping):
+    synth_hr = shared['synth_hr']
+    if dur is None:
+        return get_hr_distribution(synth_hr, fq, exhaustive, stopping)
+    return get_hr_distribution_chunks(synth_hr, fq, dur, exhaustive, stopping)
+
+
+@instrument
+def samplingDur_vs_HR(original_hr, fq, target_HRs, sample_durs, exhaustive = False, num_workers = None, seed = None, store = None, stopping = None):
     
     '''
     Determine how changing the sampling duration impacts error in calculating heart rate across heart rate amplitude
+    With num_workers the sample durations are spread over a process pool (see parallel.run_cells), reproducible from seed.
+    With a store (sweepstore.SweepStore) only the sample durations not computed before are run.
+    stopping: sequential mode as in samplingFq_vs_HR.
     '''
+    _check_stopping(exhaustive, stopping)
     
     #  synthesize data for each target HR with same temporal duration
-    synth_hr = util.synth_HR(original_hr, fq, target_HRs);
+    synth_hr = util.synth_HR_batch(original_hr, fq, target_HRs);
     
     # there will be some error between the 'target' heart rate of synthetic data and what can be estimated due to the discrete nature of peak counting
     # Thus, Use this estimated HR (rather than target HR) as a benchmark for good performance
-    estim_HRs, estim_std = get_hr_distribution(synth_hr, fq)
-    
-    results_means = np.zeros((len(target_HRs), len(sample_durs)))
-    results_error = np.zeros((len(target_HRs), len(sample_durs)))
-    results_stds = np.zeros((len(target_HRs), len(sample_durs)))
-    
-    for idx, dur in enumerate(sample_durs):
-        estim_HRs_chunk, estim_std_chunk = get_hr_distribution_chunks(synth_hr, fq, dur)
-        results_means[:,idx] = estim_HRs_chunk
-        results_stds[:,idx] = estim_std_chunk
-        results_error[:,idx] = np.abs(np.subtract(estim_HRs, estim_HRs_chunk))
-    
-    return results_error, results_means, results_stds
+    # (first cell: whole signal)
+    cells = [(fq, dur, exhaustive, stopping) for dur in [None] + list(sample_durs)]
+    cell_results = parallel.run_cells(_dur_cell, cells, dict(synth_hr = synth_hr), num_workers, seed, store)
+    return _hr_sweep_results(cell_results, target_HRs, sample_durs, 'sample_durs', stopping, store, 'samplingDur_vs_HR')
 
 ######------------ Estimate heart rate error distributions----------------######
 
+def _draw_until_converged(draw, stopping, max_iterations, omit_nan = True):
+    '''
+    Sequential Monte Carlo: call draw(n) (n new estimates) in batches until the confidence interval of their mean is
+    narrower than stopping['ci_width'] (full width, in the units of the estimates) or its half-width is below
+    stopping['rel_error'] times the mean, or max_iterations (stopping['max_iterations'] if given) are drawn.
+    Other keys: confidence (.95), batch (10), min_iterations (30). The interval uses the t distribution with count-1
+    degrees of freedom; min_iterations keeps a few lucky equal estimates (e.g. the few discrete HR values a signal
+    gives) from stopping the draws with a zero-width interval. The mean and variance are updated as the batches
+    come in; after the first batch, the next one is sized from the current interval to reach the target (at most
+    doubling the draws), which keeps the number of draw calls small. NaN estimates are left out of the interval if omit_nan, otherwise the first one stops the draws (the mean
+    is then NaN anyway). Returns all the estimates drawn and the achieved interval width.
+    '''
+    if stopping.get('ci_width') is None and stopping.get('rel_error') is None:
+        raise ValueError('stopping needs a ci_width or rel_error target')
+    max_iterations = stopping.get('max_iterations', max_iterations)
+    batch = stopping.get('batch', 10)
+    min_iterations = max(stopping.get('min_iterations', 30), 2)
+    confidence = stopping.get('confidence', .95)
+
+    samples = []
+    num_drawn, count, mean, m2 = 0, 0, 0., 0.
+    ci_width = float('nan')
+    size = batch
+    while num_drawn < max_iterations:
+        x = np.asarray(draw(min(size, max_iterations - num_drawn)), dtype=float)
+        samples.append(x)
+        num_drawn += len(x)
+        valid = x[~np.isnan(x)]
+        if len(valid) < len(x) and not omit_nan:
+            return np.concatenate(samples), float('nan')
+        if len(valid) == 0:
+            continue
 
-def get_hr_distribution(hr_synth, fq):
+        # merge the batch into the running mean and sum of squared deviations (Chan et al.)
+        batch_mean = np.mean(valid)
+        batch_m2 = np.sum((valid - batch_mean)**2)
+        delta = batch_mean - mean
+        total = count + len(valid)
+        mean += delta*len(valid)/total
+        m2 += batch_m2 + delta**2*count*len(valid)/total
+        count = total
+
+        if count >= 2:
+            ci_width = 2*stats.t.ppf(.5 + confidence/2, count-1)*np.sqrt(m2/(count-1)/count)
+        targets = []
+        if stopping.get('ci_width') is not None:
+            targets.append(stopping['ci_width'])
+        if stopping.get('rel_error') is not None:
+            targets.append(2*stopping['rel_error']*abs(mean))
+        if count >= min_iterations and ci_width <= max(targets):
+            break
+
+        # the interval narrows as 1/sqrt(count): estimate the draws still needed
+        size = batch
+        if count >= 2 and max(targets) > 0:
+            needed = count*(ci_width/max(targets))**2 - count
+            size = int(np.clip(np.ceil(needed*num_drawn/count), batch, num_drawn))
+    return np.concatenate(samples), ci_width
+
+
+def _check_stopping(exhaustive, stopping):
+    # exhaustive mode evaluates every index once, there is nothing to stop early
+    if exhaustive and stopping is not None:
+        raise ValueError('stopping only applies to random draws, not to exhaustive = True')
+
+
+def _hr_signals(hr_synth):
+    # synth_HR dict or synth_HR_batch array (one row per target HR)
+    return hr_synth.values() if isinstance(hr_synth, dict) else hr_synth
+
+
+@instrument
+def get_hr_distribution(hr_synth, fq, exhaustive = False, stopping = None):
     '''
     Meaured HR will differ somewhat depending on the starting index, get distributions for comparison
+    Peaks are found once per signal (util.PeakIndex) and the HR for every possible starting index is read from them.
+    By default starting indices are drawn at random as before; with exhaustive = True every starting index is used once,
+    which is deterministic.
+    stopping (dict, see _draw_until_converged): draw starting indices only until the mean HR of each signal has
+    converged, up to the usual number of iterations. The number of iterations and the confidence interval width of
+    each signal are then returned too: mean, std, iterations, ci_width. stopping cannot be combined with exhaustive.
     '''
+    _check_stopping(exhaustive, stopping)
     min_hr = 30
     min_BPS = min_hr/60
     max_btw_samples = int(np.ceil(fq/min_BPS))
@@ -74,19 +195,36 @@ def get_hr_distribution(hr_synth, fq):
 
     std = []
     mean = []
-    for this_hr in hr_synth.keys():
-        HR_iterations = []
-        hr_signal = hr_synth[this_hr]
-        for i in range(num_iterations):
-            start_idx = np.random.randint(max_btw_samples)
-            HR_i,_ = util.get_HR(hr_signal[start_idx:],  fq)
-            HR_iterations.append(HR_i)
+    iterations = []
+    ci_width = []
+    for hr_signal in _hr_signals(hr_synth):
+        HR_offsets = util.PeakIndex(hr_signal, fq).get_HR_offsets(np.arange(max_btw_samples))
+        ci = 0.
+        if exhaustive:
+            HR_iterations = HR_offsets
+        elif stopping is not None:
+            draw = lambda n, HR_offsets=HR_offsets: HR_offsets[np.random.randint(max_btw_samples, size = n)]
+            HR_iterations, ci = _draw_until_converged(draw, stopping, num_iterations)
+        else:
+            start_idxs = np.random.randint(max_btw_samples, size = num_iterations)
+            HR_iterations = HR_offsets[start_idxs]
         std.append(np.nanstd(HR_iterations))
         mean.append(np.nanmean(HR_iterations))
+        iterations.append(len(HR_iterations))
+        ci_width.append(ci)
         
+    if stopping is not None:
+        return mean, std, iterations, ci_width
     return mean, std
 
-def get_hr_distribution_chunks(hr_synth, fq, dur_sec):
+@instrument
+def get_hr_distribution_chunks(hr_synth, fq, dur_sec, exhaustive = False, stopping = None):
+    '''
+    Distribution of HR estimates across random segments of dur_sec. All segments of a signal are answered from one
+    util.PeakIndex; with exhaustive = True every possible segment start is used once instead of random draws.
+    stopping: sequential mode as in get_hr_distribution (returns mean, std, iterations, ci_width).
+    '''
+    _check_stopping(exhaustive, stopping)
     min_hr = 30
     min_BPS = min_hr/60
     max_btw_samples = int(np.ceil(fq/min_BPS))
@@ -96,21 +234,30 @@ def get_hr_distribution_chunks(hr_synth, fq, dur_sec):
     
     std = []
     mean = []
-    for this_hr in hr_synth.keys():
-        hr_signal = hr_synth[this_hr]
+    iterations = []
+    ci_width = []
+    for hr_signal in _hr_signals(hr_synth):
         N = len(hr_signal)
         seconds_of_data = N/fq
         N_desired_dur = int(dur_sec*fq)
         
-        HR_iterations = []
-        
-        for i in range(num_iterations):
-            start_idx = np.random.randint(N-N_desired_dur)
-            HR_i,_ = util.get_HR(hr_signal[start_idx:start_idx+N_desired_dur],  fq)
-            HR_iterations.append(HR_i)
+        peaks = util.PeakIndex(hr_signal, fq)
+        ci = 0.
+        if exhaustive:
+            HR_iterations = peaks.get_HR_windows(np.arange(N-N_desired_dur), N_desired_dur)
+        elif stopping is not None:
+            draw = lambda n, peaks=peaks, N=N, L=N_desired_dur: peaks.get_HR_windows(np.random.randint(N-L, size = n), L)
+            HR_iterations, ci = _draw_until_converged(draw, stopping, num_iterations)
+        else:
+            start_idxs = np.random.randint(N-N_desired_dur, size = num_iterations)
+            HR_iterations = peaks.get_HR_windows(start_idxs, N_desired_dur)
         std.append(np.nanstd(HR_iterations))
         mean.append(np.nanmean(HR_iterations))
+        iterations.append(len(HR_iterations))
+        ci_width.append(ci)
         
+    if stopping is not None:
+        return mean, std, iterations, ci_width
     return mean, std
 
 
@@ -119,39 +266,59 @@ def get_hr_distribution_chunks(hr_synth, fq, dur_sec):
 
 
 
+@instrument
 def test_data_rate(data_synth, sample_dur_sec, inter_sample_sec):
 #     sample_dur_sec : collect X seconds of data at a time; AVERAGE within this period = spo2 output
 #     inter_sample_sec : collect a data sample every X minutes
 
-    N = len(data_synth['spo2'])
+    N = len(data_synth['red_AC'])
     sampling_rate = data_synth['sampling_rate']
-    tile_range = data_synth['tile_range']
     sampling_period = int((inter_sample_sec+sample_dur_sec)*sampling_rate)
 
     first_sample  = np.random.randint(sampling_period) # randomize starting index!
     sample_starts = np.arange(first_sample, N, sampling_period)
-    sample_ends   = [i + int(sample_dur_sec*sampling_rate) for i in sample_starts]
+    sample_len    = int(sample_dur_sec*sampling_rate)
+    sample_ends   = sample_starts + sample_len
 
-    spo2 = []
-    d = dict()
-    d['sampling_rate'] = data_synth['sampling_rate']
-    for iO,iN in zip(sample_starts, sample_ends):
+    # same as util.getSpO2 + np.nanmean on each sample, for all samples at once
+    spo2 = util.getSpO2_windows(data_synth, sample_starts, sample_len)
 
-        d['red_AC'] = data_synth['red_AC'][iO:iN]
-        d['red_DC'] = data_synth['red_DC'][iO:iN]
-        d['IR_AC'] = data_synth['IR_AC'][iO:iN]
-        d['IR_DC'] = data_synth['IR_DC'][iO:iN]
+    return spo2, sample_ends
 
-        h = util.getSpO2(d, tile_range)
-        spo2.append(np.nanmean(h['spo2']))
 
-    return np.array(spo2), np.array(sample_ends)
 
+@instrument
+def test_data_rate_phases(data_synth, sample_dur_sec, inter_sample_sec, stride = 1):
+    '''
+    test_data_rate for every starting index 0, stride, 2*stride, ... within one sampling period, all at once.
+    Returns (starting indices x samples) arrays of spo2 and sample ends; rows with fewer samples are padded with nan.
+    '''
+    N = len(data_synth['red_AC'])
+    sampling_rate = data_synth['sampling_rate']
+    sampling_period = int((inter_sample_sec+sample_dur_sec)*sampling_rate)
+    sample_len    = int(sample_dur_sec*sampling_rate)
 
+    first_samples = np.arange(0, sampling_period, stride)
+    sample_starts = first_samples[:,None] + np.arange(int(np.ceil(N/sampling_period)))*sampling_period
+    in_data = sample_starts < N
 
-def get_alarm_time_distribution(data_synth, sample_dur_sec, inter_sample_sec, spo2_thresh, num_iterations = 40):
-    ''' for the same data, alarm time will depend on how the samples are shifted with respect to the drop in Spo2. Randomize the shift and measure the distribution.
+    spo2 = np.full(sample_starts.shape, float('nan'))
+    spo2[in_data] = util.getSpO2_windows(data_synth, sample_starts[in_data], sample_len)
+    sample_ends = np.where(in_data, sample_starts + sample_len, float('nan'))
+    return spo2, sample_ends
+
+
+@instrument
+def get_alarm_times(spo2, sample_ends, spo2_thresh):
     '''
+    First sample end below spo2_thresh in each row of the output of test_data_rate_phases, nan if there is none.
+    '''
+    low_spo2 = spo2 < spo2_thresh
+    first = np.argmax(low_spo2, axis = 1)
+    return np.where(np.any(low_spo2, axis = 1), sample_ends[np.arange(len(first)), first], float('nan'))
+
+
+def _random_alarm_times(data_synth, sample_dur_sec, inter_sample_sec, spo2_thresh, num_iterations):
     alarm_times = []
     for i in range(num_iterations):
         spo2, sample_ends = test_data_rate(data_synth, sample_dur_sec, inter_sample_sec)
@@ -159,30 +326,206 @@ def get_alarm_time_distribution(data_synth, sample_dur_sec, inter_sample_sec, sp
         try:
             alarm_times.append(low_spo2[0])
         except:
-            alarm_times.append(np.float('Nan'))
-    alarm_times = np.array(alarm_times)
-    return np.mean(alarm_times), np.std(alarm_times)
+            alarm_times.append(float('nan'))
+    return np.array(alarm_times)
+
+
+def _samples_stopping(stopping, sampling_rate):
+    # stopping with ci_width in seconds -> in samples, the unit of the alarm times
+    if stopping is not None and stopping.get('ci_width') is not None:
+        stopping = dict(stopping, ci_width = stopping['ci_width']*sampling_rate)
+    return stopping
+
 
+@instrument
+def get_alarm_time_distribution(data_synth, sample_dur_sec, inter_sample_sec, spo2_thresh, num_iterations = 40, exhaustive = False, stride = 1, percentiles = None, stopping = None):
+    ''' for the same data, alarm time will depend on how the samples are shifted with respect to the drop in Spo2. Randomize the shift and measure the distribution.
+    With exhaustive = True every shift (or every stride-th one) is evaluated instead, which gives the exact and deterministic distribution.
+    If percentiles are given they are returned as well: mean, std, percentiles.
+    stopping (dict, see _draw_until_converged; ci_width in seconds as in inter_sample_vs_alarm_time): shifts are drawn
+    only until the mean alarm time has converged, up to num_iterations, and the number of iterations and the achieved
+    interval width (s) are returned last. A shift that never alarms makes the mean NaN and stops the draws.
+    stopping cannot be combined with exhaustive.
+    '''
+    _check_stopping(exhaustive, stopping)
+    sampling_rate = data_synth['sampling_rate']
+    stopping = _samples_stopping(stopping, sampling_rate)
+    ci = 0.
+    if exhaustive:
+        spo2, sample_ends = test_data_rate_phases(data_synth, sample_dur_sec, inter_sample_sec, stride)
+        alarm_times = get_alarm_times(spo2, sample_ends, spo2_thresh)
+    elif stopping is not None:
+        draw = lambda n: _random_alarm_times(data_synth, sample_dur_sec, inter_sample_sec, spo2_thresh, n)
+        alarm_times, ci = _draw_until_converged(draw, stopping, num_iterations, omit_nan = False)
+    else:
+        alarm_times = _random_alarm_times(data_synth, sample_dur_sec, inter_sample_sec, spo2_thresh, num_iterations)
+    result = (np.mean(alarm_times), np.std(alarm_times))
+    if percentiles is not None:
+        result += (np.percentile(alarm_times, percentiles),)
+    if stopping is not None:
+        result += (len(alarm_times), ci/sampling_rate)
+    return result
+
+
+def _alarm_time_cell(data_synth, sample_dur_sec, inter, thresholds, exhaustive, stride, percentiles, stopping):
+    if exhaustive:
+        # the samples do not depend on the threshold, take them once for all thresholds
+        spo2, sample_ends = test_data_rate_phases(data_synth, sample_dur_sec, inter, stride)
+    means, stds, prctiles, iterations, ci_widths = [], [], [], [], []
+    for thresh in thresholds:
+        ci = 0.
+        if exhaustive:
+            alarm_times = get_alarm_times(spo2, sample_ends, thresh)
+        elif stopping is not None:
+            draw = lambda n, thresh=thresh: _random_alarm_times(data_synth, sample_dur_sec, inter, thresh, n)
+            alarm_times, ci = _draw_until_converged(draw, stopping, 40, omit_nan = False)
+        else:
+            alarm_times = _random_alarm_times(data_synth, sample_dur_sec, inter, thresh, 40)
+        means.append(np.mean(alarm_times))
+        stds.append(np.std(alarm_times))
+        if percentiles is not None:
+            prctiles.append(np.percentile(alarm_times, percentiles))
+        iterations.append(len(alarm_times))
+        ci_widths.append(ci)
+    return means, stds, prctiles, iterations, ci_widths
+
+
+@instrument
+def inter_sample_vs_alarm_time(data_synth, params, sample_dur_sec, inter_sample_sec, spo2_thresh, exhaustive = False, stride = 1, percentiles = None, num_workers = None, seed = None, store = None, stopping = None):
+    '''
+    With exhaustive = True all shifts are evaluated (see get_alarm_time_distribution); the samples do not depend on the
+    threshold, so they are taken once per inter sample spacing. If percentiles are given, a third array
+    (thresholds x inter sample spacings x percentiles) of alarm time percentiles is returned, relative to the same baseline.
+    With num_workers the grid cells are spread over a process pool with data_synth in shared memory
+    (see parallel.run_cells), reproducible from seed.
+    With a store (sweepstore.SweepStore) only the cells not computed before are run; exhaustive cells cover all
+    thresholds, so adding thresholds recomputes them.
+    stopping (dict, see _draw_until_converged; ci_width in seconds): each cell draws shifts only until its mean alarm
+    time has converged, up to 40; arrays of the iterations used and of the achieved interval widths (s) are returned last.
+    stopping cannot be combined with exhaustive.
+    '''
+    _check_stopping(exhaustive, stopping)
+    sampling_rate = data_synth['sampling_rate']
+    stopping = _samples_stopping(stopping, sampling_rate)
+    if exhaustive:
+        cells = [(sample_dur_sec, inter, spo2_thresh, exhaustive, stride, percentiles, stopping) for inter in inter_sample_sec]
+        positions = [(slice(None), i2) for i2 in range(len(inter_sample_sec))]
+    else:
+        cells = [(sample_dur_sec, inter, [thresh], exhaustive, stride, percentiles, stopping) for thresh in spo2_thresh for inter in inter_sample_sec]
+        positions = [([i1], i2) for i1 in range(len(spo2_thresh)) for i2 in range(len(inter_sample_sec))]
+    cell_results = parallel.run_cells(_alarm_time_cell, cells, data_synth, num_workers, seed, store)
 
-def inter_sample_vs_alarm_time(data_synth, params, sample_dur_sec, inter_sample_sec, spo2_thresh):
     results_means = np.zeros((len(spo2_thresh), len(inter_sample_sec)))
     results_stds = np.zeros((len(spo2_thresh), len(inter_sample_sec)))
-    for i1, thresh in enumerate(spo2_thresh):
-        for i2, inter in enumerate(inter_sample_sec):
-            mn, std = get_alarm_time_distribution(data_synth, sample_dur_sec, inter, thresh)
-            results_means[i1,i2] = mn
-            results_stds[i1,i2]  = std
-    alarm_times_sec = np.subtract(results_means, np.reshape(results_means[:,0],(-1,1)))/data_synth['sampling_rate']
-    alarm_times_stds = results_stds/data_synth['sampling_rate']
-    return alarm_times_sec, alarm_times_stds
+    results_prctiles = np.zeros((len(spo2_thresh), len(inter_sample_sec), np.size(percentiles)))
+    results_iterations = np.zeros((len(spo2_thresh), len(inter_sample_sec)), dtype=int)
+    results_ci = np.zeros((len(spo2_thresh), len(inter_sample_sec)))
+    for (i1, i2), (means, stds, prctiles, iterations, ci_widths) in zip(positions, cell_results):
+        results_means[i1,i2] = means
+        results_stds[i1,i2]  = stds
+        if percentiles is not None:
+            results_prctiles[i1,i2] = prctiles
+        results_iterations[i1,i2] = iterations
+        results_ci[i1,i2] = ci_widths
+    alarm_times_sec = np.subtract(results_means, np.reshape(results_means[:,0],(-1,1)))/sampling_rate
+    alarm_times_stds = results_stds/sampling_rate
+    results = dict(alarm_times_sec = alarm_times_sec, alarm_times_stds = alarm_times_stds)
+    if percentiles is not None:
+        results['alarm_times_prctiles'] = np.subtract(results_prctiles, np.reshape(results_means[:,0],(-1,1,1)))/sampling_rate
+    if stopping is not None:
+        results['iterations'] = results_iterations
+        results['ci_width_sec'] = results_ci/sampling_rate
+    if store is not None:
+        store.save_grid('inter_sample_vs_alarm_time', dict(inter_sample_sec = inter_sample_sec, spo2_thresh = spo2_thresh), results)
+    output = (alarm_times_sec, alarm_times_stds)
+    if percentiles is not None:
+        output += (results['alarm_times_prctiles'],)
+    if stopping is not None:
+        output += (results['iterations'], results['ci_width_sec'])
+    return output
 
 
 ##########---------------------------Battery-------------------------------##############
 
 def get_battery_fraction(sample_dur_sec, inter_sample_sec, prcile_orange):
-    proportion_on_green = sample_dur_sec/(sample_dur_sec+inter_sample_sec)
-    results = np.zeros((len(proportion_on_green),len(prcile_orange)))
-    for i1, pg in enumerate(proportion_on_green):
-        for i2, po in enumerate(prcile_orange):
-            results[i1,i2] = pg*(1-po) + 1*po
+    proportion_on_green = sample_dur_sec/(sample_dur_sec+np.asarray(inter_sample_sec))
+    # on for sample_dur_sec every sample_dur_sec+inter_sample_sec in green, all the time in orange
+    return proportion_on_green[:,None]*(1-np.asarray(prcile_orange)) + np.asarray(prcile_orange)
+
+
+##########---------------------------Adaptive sampling policy-------------------------------##############
+
+@instrument
+def simulate_policy(data_synth, sample_dur_sec, inter_sample_sec, green_thresh, red_thresh, num_phases = 20):
+    '''
+    Simulate the SpO2-aware sampling strategy (plotting.plot_color_range) on synthetic data for every combination of
+    inter_sample_sec, green_thresh and red_thresh at once:
+    - each sample is sample_dur_sec of data, averaged as in test_data_rate
+    - after a reading >= green_thresh (green) the sensor sleeps inter_sample_sec, after a lower one (orange) the next
+      sample follows immediately, until a reading is green again
+    - the alarm goes off at the end of the first sample reading < red_thresh
+    Each setting is run from num_phases starting offsets spread over its first sampling period.
+
+    Returns a dict of arrays indexed [inter, green(, red)]:
+    'battery_fraction': fraction of the time the sensor is on (1 = continuous), as get_battery_fraction
+    'orange_fraction': fraction of the time spent sampling continuously
+    'alarm_latency_sec' (mean over phases), 'alarm_latency_std': delay from the first time the continuously sampled
+    SpO2 (data_synth['spo2'], or getSpO2_decimated at full rate for lazy data) drops below red_thresh to the alarm;
+    nan if either never happens
+    'alarm_rate': fraction of the phases that raised the alarm
+    '''
+    N = len(data_synth['red_AC'])
+    sampling_rate = data_synth['sampling_rate']
+    sample_len = int(sample_dur_sec*sampling_rate)
+    inter_sample_sec = np.atleast_1d(np.asarray(inter_sample_sec, dtype=float))
+    green_thresh = np.atleast_1d(np.asarray(green_thresh, dtype=float))
+    red_thresh = np.atleast_1d(np.asarray(red_thresh, dtype=float))
+
+    # the reading of a sample starting at any index, so each step of the simulation is a lookup
+    reading = util.getSpO2_windows(data_synth, np.arange(N), sample_len)
+
+    # one simulation per (inter, green, phase), flattened
+    inter_len = (inter_sample_sec*sampling_rate).astype(int)
+    shape = (len(inter_sample_sec), len(green_thresh), num_phases)
+    sleep = np.broadcast_to(inter_len[:,None,None], shape).ravel()
+    green = np.broadcast_to(green_thresh[None,:,None], shape).ravel()
+    phases = np.arange(num_phases)/num_phases
+    start = (np.broadcast_to(phases, shape)*(sample_len + np.broadcast_to(inter_len[:,None,None], shape))).astype(int).ravel()
+
+    on = np.zeros(len(start))
+    orange = np.zeros(len(start))
+    alarm = np.full((len(start), len(red_thresh)), float('nan'))
+    running = start < N
+    while np.any(running):
+        idx = np.flatnonzero(running)
+        value = reading[start[idx]]
+        end = start[idx] + sample_len
+        duration = np.minimum(end, N) - start[idx]
+        on[idx] += duration
+        is_orange = value < green[idx]
+        orange[idx] += np.where(is_orange, duration, 0)
+
+        first_low = np.isnan(alarm[idx]) & (value[:,None] < red_thresh)
+        alarm[idx] = np.where(first_low, end[:,None], alarm[idx])
+
+        start[idx] = end + np.where(is_orange, 0, sleep[idx])
+        running[idx] = start[idx] < N
+
+    # first index where the continuously sampled SpO2 is below each red threshold
+    if 'spo2' in data_synth:
+        spo2 = np.asarray(data_synth['spo2'])
+    else:
+        spo2 = util.getSpO2_decimated(data_synth, 1)['spo2'] # lazy trace, computed block by block
+    below = spo2[:,None] < red_thresh
+    true_alarm = np.where(np.any(below, axis=0), np.argmax(below, axis=0), float('nan'))
+    latency = ((alarm - true_alarm)/sampling_rate).reshape(shape + (len(red_thresh),))
+
+    results = dict()
+    results['battery_fraction'] = (on/N).reshape(shape).mean(axis=2)
+    results['orange_fraction'] = (orange/N).reshape(shape).mean(axis=2)
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning) # settings that never raise the alarm
+        results['alarm_latency_sec'] = np.nanmean(latency, axis=2)
+        results['alarm_latency_std'] = np.nanstd(latency, axis=2)
+    results['alarm_rate'] = np.mean(~np.isnan(latency), axis=2)
     return results
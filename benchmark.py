@@ -0,0 +1,201 @@
+'''
+Benchmarks of the util and analysis hot paths on the bundled recordings, plus the accuracy of the SpO2/HR estimates
+against the reference readings in the file names, so speedups can be checked against losses in signal fidelity.
+
+    python benchmark.py --out before.json
+    python benchmark.py --out after.json --compare before.json
+
+Each benchmark records the best and median wall time over --repeat runs and the peak memory allocated (tracemalloc,
+from a separate run). Input sizes: the demo recordings looped 1x/8x/64x, synthetic recordings with 5/20/90 minute
+recoveries, and small/full sweep grids. --quick keeps only the smallest size of each.
+'''
+
+import os
+import json
+import time
+import argparse
+import platform
+import subprocess
+import tracemalloc
+import warnings
+import numpy as np
+import scipy
+import util
+import analysis
+import loader
+import catalog
+
+
+DEMO_FILES = {'proto2': '20201012-180354-9697-6264.csv', 'proto1': '1515-97-74.csv'}
+DEMO_TILE_RANGE = [50, 773] # demo.ipynb
+SYNTH_PARAMS = dict(baseline_spo2 = 94, drop_time_sec = 2*60, drop_frac = 0.75, noise = 15) # shunt PPH average (plotting.py)
+
+
+##########---------------------------Measurement-------------------------------##############
+
+def measure(func, repeat = 3):
+    '''
+    Run func() repeat times; returns best and median wall time (s) and the peak traced memory (MB) of one more run.
+    '''
+    times = []
+    for _ in range(repeat):
+        np.random.seed(0)
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+
+    np.random.seed(0)
+    tracemalloc.start()
+    try:
+        func()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return dict(wall_sec = min(times), wall_sec_median = float(np.median(times)), peak_mb = peak/2**20)
+
+
+def _revision():
+    try:
+        out = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                             stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, universal_newlines=True)
+        return out.stdout.strip() or None
+    except OSError:
+        return None
+
+
+##########---------------------------Inputs-------------------------------##############
+
+def _demo(device, data_dir):
+    recording = loader.load_recording(os.path.join(data_dir, device, DEMO_FILES[device]))
+    red, IR = np.asarray(recording['red']), np.asarray(recording['IR'])
+    return red, IR, recording['sampling_rate']
+
+
+def _cases(data_dir, quick):
+    # (name, size, function) triplets; inputs are prepared here so only the call itself is timed
+    tiles = [1] if quick else [1, 8, 64]
+    recover_min = [5] if quick else [5, 20, 90]
+    cases = []
+
+    for device in ['proto1', 'proto2']:
+        red, IR, fs = _demo(device, data_dir)
+        for n in tiles:
+            red_n, IR_n = np.tile(red, n), np.tile(IR, n)
+            data = util.getSpO2(util.decompose_ACDC(red_n, IR_n, fs), [0, len(red_n)])
+            size = '%s x%d (%d samples)' % (device, n, len(red_n))
+            cases.append(('decompose_ACDC', size, lambda r=red_n, i=IR_n, f=fs: util.decompose_ACDC(r, i, f)))
+            cases.append(('getSpO2', size, lambda d=data: util.getSpO2(d, d['tile_range'])))
+            cases.append(('get_HR', size, lambda d=data, f=fs: util.get_HR(-d['red_AC'], f)))
+
+    red, IR, fs = _demo('proto2', data_dir)
+    data = util.getSpO2(util.decompose_ACDC(red, IR, fs), DEMO_TILE_RANGE)
+    hr_signal = -data['red_AC'][DEMO_TILE_RANGE[0]:DEMO_TILE_RANGE[1]]
+    target_HRs = np.arange(40, 220, 10)
+    cases.append(('synth_HR', '%d target HRs' % len(target_HRs), lambda: util.synth_HR(hr_signal, fs, target_HRs)))
+
+    synths = dict()
+    for minutes in recover_min:
+        params = dict(SYNTH_PARAMS, recover_time_sec = minutes*60)
+        cases.append(('synthesize_SpO2', '%d min recovery' % minutes, lambda p=params: util.synthesize_SpO2(data, p)))
+        np.random.seed(0)
+        synths[minutes] = util.synthesize_SpO2(data, params)
+
+    data_synth = synths[recover_min[-1]]
+    size = '%d min recovery' % recover_min[-1]
+    for inter in [0, 30, 300]:
+        cases.append(('test_data_rate', size + ', every %d s' % inter,
+                      lambda i=inter: analysis.test_data_rate(data_synth, 5, i)))
+    cases.append(('get_alarm_time_distribution', size + ', 40 iterations',
+                  lambda: analysis.get_alarm_time_distribution(data_synth, 5, 60, 90, num_iterations = 40)))
+
+    original_hr = -np.tile(data['red_AC'][16:], 2)
+    grids = [('small', np.arange(40, 220, 40), np.arange(8, 51, 14), [5, 20], [0, 60, 300], [92, 90])]
+    if not quick:
+        grids.append(('full', target_HRs, np.arange(8, 51, 2), [3, 5, 10, 20, 30], [0, 5, 10, 30, 60, 180],
+                      np.arange(93, 88, -.5)))
+    for grid, HRs, rates, durs, inters, thresholds in grids:
+        cases.append(('samplingFq_vs_HR', '%s grid (%dx%d)' % (grid, len(HRs), len(rates)),
+                      lambda H=HRs, r=rates: analysis.samplingFq_vs_HR(original_hr, fs, H, r)))
+        cases.append(('samplingDur_vs_HR', '%s grid (%dx%d)' % (grid, len(HRs), len(durs)),
+                      lambda H=HRs, d=durs: analysis.samplingDur_vs_HR(original_hr, fs, H, d)))
+        cases.append(('inter_sample_vs_alarm_time', '%s grid (%dx%d)' % (grid, len(thresholds), len(inters)),
+                      lambda i=inters, t=thresholds: analysis.inter_sample_vs_alarm_time(data_synth, None, 5, np.array(i), np.array(t))))
+    return cases
+
+
+##########---------------------------Accuracy-------------------------------##############
+
+def accuracy(data_dir = loader.DATA_DIR):
+    '''
+    SpO2 and HR estimated from every recording (catalog.estimate) vs the reference readings in the file names.
+    Returns the per-file results and, per device, the mean absolute error to the reference midpoint and range.
+    '''
+    files = []
+    for path in loader.list_recordings(data_dir):
+        recording = loader.load_recording(path)
+        _, spo2, hr = catalog.estimate(recording['red'], recording['IR'], recording['sampling_rate'])
+        result = dict(name = recording['name'], device = recording['device'], spo2 = spo2, hr = hr,
+                      ref_spo2 = recording['ref_spo2'], ref_hr = recording['ref_hr'])
+        result['spo2_range_error'], result['spo2_error'] = catalog.reference_error(spo2, recording['ref_spo2'])
+        result['hr_range_error'], result['hr_error'] = catalog.reference_error(hr, recording['ref_hr'])
+        files.append(result)
+    return dict(files = files, summary = catalog.error_summary(files))
+
+
+##########---------------------------Run/compare-------------------------------##############
+
+def run(data_dir = loader.DATA_DIR, quick = False, repeat = 3, names = None):
+    '''
+    Run the benchmarks (only those in names, if given) and the accuracy check; returns a JSON-serializable dict
+    '''
+    timings = []
+    for name, size, func in _cases(data_dir, quick):
+        if names and name not in names:
+            continue
+        result = dict(name = name, size = size)
+        result.update(measure(func, repeat))
+        timings.append(result)
+        print('%-28s %-36s %9.4f s %9.1f MB' % (name, size, result['wall_sec'], result['peak_mb']), flush=True)
+
+    meta = dict(revision = _revision(), time = time.strftime('%Y-%m-%d %H:%M:%S'), python = platform.python_version(),
+                numpy = np.__version__, scipy = scipy.__version__, machine = platform.machine(), quick = quick,
+                repeat = repeat)
+    return dict(meta = meta, timings = timings, accuracy = accuracy(data_dir))
+
+
+def compare(old, new):
+    '''
+    Print wall time and peak memory ratios (new/old) of the benchmarks in both results, and the accuracy summaries
+    '''
+    old_timings = {(t['name'], t['size']): t for t in old['timings']}
+    print('%-28s %-36s %10s %10s %8s %8s' % ('', '', 'old s', 'new s', 'speedup', 'mem'))
+    for t in new['timings']:
+        o = old_timings.get((t['name'], t['size']))
+        if o is None:
+            continue
+        print('%-28s %-36s %10.4f %10.4f %7.2fx %7.2fx' % (t['name'], t['size'], o['wall_sec'], t['wall_sec'],
+              o['wall_sec']/max(t['wall_sec'], 1e-12), t['peak_mb']/max(o['peak_mb'], 1e-12)))
+    for device, stats in new['accuracy']['summary'].items():
+        before = old['accuracy']['summary'].get(device, dict())
+        for key, value in stats.items():
+            if key.startswith('mae') and value is not None:
+                print('%s %-20s old %8.3f new %8.3f' % (device, key, before.get(key) or float('nan'), value))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the util/analysis hot paths and the estimate accuracy')
+    parser.add_argument('--out', default='benchmark.json', help='where to write the results (JSON)')
+    parser.add_argument('--compare', help='earlier results (JSON) to compare against')
+    parser.add_argument('--data-dir', default=loader.DATA_DIR)
+    parser.add_argument('--quick', action='store_true', help='smallest input size only')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--only', nargs='*', help='benchmark names to run')
+    args = parser.parse_args()
+
+    warnings.simplefilter('ignore', RuntimeWarning) # all-NaN windows
+    results = run(args.data_dir, args.quick, args.repeat, args.only)
+    with open(args.out, 'w') as f:
+        json.dump(results, f, indent=1)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), results)
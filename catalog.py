@@ -0,0 +1,195 @@
+'''
+Catalog of the spo2-data recordings with per-file features computed once and kept on disk.
+
+For every recording the index holds the device, reference SpO2/HR ranges (from the file name), duration, notes and
+the estimated SpO2 (util.getSpO2), HR (util.get_HR) and a suggested tile_range (util.suggest_tile_range). The
+decompose_ACDC/getSpO2 arrays are stored next to it, so a query returns data ready for synthesize_SpO2 etc. without
+filtering again. Entries are recomputed when the source file or PIPELINE_VERSION changes.
+
+    entries = catalog.query(catalog.build_catalog(), device='proto2', spo2_max=95, side='r')
+    data = [catalog.load_features(e) for e in entries]
+'''
+
+import os
+import json
+import numpy as np
+import util
+import loader
+
+
+PIPELINE_VERSION = 1
+FEATURES = ['red_AC', 'red_DC', 'IR_AC', 'IR_DC', 'ratio', 'spo2']
+
+
+def _catalog_dir(cache_dir):
+    return os.path.join(cache_dir, 'catalog')
+
+
+def _side(notes):
+    tokens = notes.split('-')
+    for side in ['l', 'r']:
+        if side in tokens:
+            return side
+    return None
+
+
+def estimate(red, infrared, sampling_rate, sec_to_avg = 3, detector = 'percentile'):
+    '''
+    decompose_ACDC + getSpO2 (with suggest_tile_range) of a recording, and its SpO2 (median) and HR estimates (None if
+    they cannot be estimated). Returns data, spo2, hr.
+    '''
+    data = util.decompose_ACDC(np.asarray(red), np.asarray(infrared), sampling_rate)
+    data = util.getSpO2(data, util.suggest_tile_range(data), sec_to_avg)
+    # the PPG signal is inverted (more blood = less light), so peaks of -AC are heart beats
+    hr, _ = util.get_HR(-data['red_AC'], sampling_rate, detector)
+
+    spo2 = float(np.nanmedian(data['spo2'])) if np.any(~np.isnan(data['spo2'])) else None
+    hr = None if np.isnan(hr) else float(hr)
+    return data, spo2, hr
+
+
+def reference_error(estimate, reference):
+    '''
+    Distance of an estimate from a reference (low, high) range (0 inside it) and from its midpoint; None, None if
+    either is missing
+    '''
+    if estimate is None or reference is None:
+        return None, None
+    low, high = reference
+    return max(low - estimate, estimate - high, 0), abs(estimate - (low + high)/2)
+
+
+def error_summary(rows):
+    '''
+    Per device of rows (dicts with 'device' and the spo2/hr errors from reference_error): num_files, and for each of
+    spo2_error, spo2_range_error, hr_error and hr_range_error the mean absolute error (mae_<key>, None if there is
+    no reference) and the number of files it is taken over (num_<key>)
+    '''
+    summary = dict()
+    for device in sorted(set(row['device'] for row in rows)):
+        device_rows = [row for row in rows if row['device'] == device]
+        stats = dict(num_files = len(device_rows))
+        for key in ['spo2_error', 'spo2_range_error', 'hr_error', 'hr_range_error']:
+            errors = [row[key] for row in device_rows if row[key] is not None]
+            stats['mae_' + key] = float(np.mean(errors)) if errors else None
+            stats['num_' + key] = len(errors)
+        summary[device] = stats
+    return summary
+
+
+def _make_entry(path, cache_dir):
+    recording = loader.load_recording(path, cache_dir)
+    sampling_rate = recording['sampling_rate']
+    data, spo2, hr = estimate(recording['red'], recording['IR'], sampling_rate)
+
+    features_path = os.path.join(_catalog_dir(cache_dir), recording['device'], recording['name'] + '.npy')
+    os.makedirs(os.path.dirname(features_path), exist_ok=True)
+    loader.write_atomic(features_path, lambda f: np.save(f, np.stack([data[key] for key in FEATURES])))
+
+    stat = os.stat(path)
+    entry = dict()
+    for key in ['name', 'device', 'time', 'ref_spo2', 'ref_hr', 'notes', 'sampling_rate']:
+        entry[key] = recording[key]
+    entry['side'] = _side(recording['notes'])
+    entry['attached'] = 'unattached' not in recording['notes']
+    entry['num_samples'] = len(recording['red'])
+    entry['duration_sec'] = len(recording['red'])/sampling_rate
+    entry['spo2'] = spo2
+    entry['hr'] = hr
+    entry['tile_range'] = data['tile_range']
+    entry['path'] = os.path.abspath(path)
+    entry['features_path'] = features_path
+    entry['source'] = dict(size = stat.st_size, mtime_ns = stat.st_mtime_ns)
+    entry['version'] = PIPELINE_VERSION
+    return entry
+
+
+def build_catalog(data_dir = loader.DATA_DIR, devices = ('proto1', 'proto2'), cache_dir = None):
+    '''
+    Index of all recordings (list of dicts, see the module docstring), updating only the entries whose source file
+    changed since the last call.
+    '''
+    if cache_dir is None:
+        cache_dir = os.path.join(data_dir, '.cache')
+    index_path = os.path.join(_catalog_dir(cache_dir), 'index.json')
+    index = dict()
+    if os.path.exists(index_path):
+        with open(index_path) as f:
+            index = json.load(f)
+
+    entries = []
+    changed = False
+    for path in loader.list_recordings(data_dir, devices):
+        key = os.path.abspath(path)
+        stat = os.stat(path)
+        entry = index.get(key)
+        if (entry is None or entry['version'] != PIPELINE_VERSION or not os.path.exists(entry['features_path']) or
+                entry['source'] != dict(size = stat.st_size, mtime_ns = stat.st_mtime_ns)):
+            entry = _make_entry(path, cache_dir)
+            index[key] = entry
+            changed = True
+        entries.append(entry)
+
+    if changed:
+        os.makedirs(os.path.dirname(index_path), exist_ok=True)
+        loader.write_atomic(index_path, lambda f: f.write(json.dumps(index, indent=1).encode()))
+    for entry in entries:
+        for key in ['ref_spo2', 'ref_hr']:
+            if entry[key] is not None:
+                entry[key] = tuple(entry[key])
+    return entries
+
+
+def _in_range(reading, low, high):
+    # reading is a (min, max) reference range; both ends have to be within [low, high]
+    if reading is None:
+        return low is None and high is None
+    return (low is None or reading[0] >= low) and (high is None or reading[1] <= high)
+
+
+def query(entries, device = None, spo2_min = None, spo2_max = None, hr_min = None, hr_max = None, side = None,
+          attached = None, notes = None, min_duration_sec = None, max_duration_sec = None):
+    '''
+    Catalog entries matching all the given conditions. SpO2/HR limits apply to the reference readings from the file
+    names; side is 'l' or 'r'; notes matches a substring of the file name notes.
+    '''
+    selected = []
+    for entry in entries:
+        if device is not None and entry['device'] != device:
+            continue
+        if not _in_range(entry['ref_spo2'], spo2_min, spo2_max) or not _in_range(entry['ref_hr'], hr_min, hr_max):
+            continue
+        if side is not None and entry['side'] != side:
+            continue
+        if attached is not None and entry['attached'] != attached:
+            continue
+        if notes is not None and notes not in entry['notes']:
+            continue
+        if min_duration_sec is not None and entry['duration_sec'] < min_duration_sec:
+            continue
+        if max_duration_sec is not None and entry['duration_sec'] > max_duration_sec:
+            continue
+        selected.append(entry)
+    return selected
+
+
+def load_features(entry, mmap = True):
+    '''
+    The stored decompose_ACDC + getSpO2 output of a catalog entry, as the dict those functions return, with the
+    raw red/IR from the loader cache and the suggested tile_range. Arrays are memory-mapped read-only unless mmap = False.
+    '''
+    # features live in <cache>/catalog/<device>/, next to the loader's own cache
+    cache_dir = os.path.dirname(os.path.dirname(os.path.dirname(entry['features_path'])))
+    recording = loader.load_recording(entry['path'], cache_dir, mmap = mmap)
+    table = np.load(entry['features_path'], mmap_mode='r' if mmap else None)
+    N = entry['num_samples']
+
+    data = dict()
+    data['red'] = recording['red']
+    data['IR'] = recording['IR']
+    for i, key in enumerate(FEATURES):
+        data[key] = table[i]
+    data['sampling_rate'] = entry['sampling_rate']
+    data['time_min'] = np.linspace(0,N/data['sampling_rate'],N)/60
+    data['tile_range'] = entry['tile_range']
+    return data
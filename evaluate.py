@@ -0,0 +1,160 @@
+'''
+Evaluate the SpO2/HR pipeline (decompose_ACDC -> getSpO2 -> get_HR, see catalog.estimate) on every recording and
+compare the estimates with the reference readings in the file names.
+
+    python evaluate.py --out evaluation.csv
+
+Recordings are spread over a process pool (one per core by default). Results are kept in <cache>/evaluate/results.json
+and reused while a recording's file and the pipeline parameters are unchanged, so after adding a session of new
+recordings only those are processed. The summary table has one row per recording with the estimates, the reference
+ranges, the errors and the time spent loading and estimating.
+'''
+
+import os
+import csv
+import json
+import time
+import argparse
+import warnings
+import numpy as np
+import loader
+import catalog
+import parallel
+from memo import hash_key
+
+
+COLUMNS = ['name', 'device', 'spo2', 'ref_spo2', 'spo2_error', 'spo2_range_error', 'hr', 'ref_hr', 'hr_error',
+           'hr_range_error', 'duration_sec', 'load_sec', 'estimate_sec', 'notes']
+
+
+def _results_path(cache_dir):
+    return os.path.join(cache_dir, 'evaluate', 'results.json')
+
+
+def _source(path):
+    stat = os.stat(path)
+    return dict(size = stat.st_size, mtime_ns = stat.st_mtime_ns)
+
+
+def params_key(params):
+    '''
+    Fingerprint of the pipeline parameters (and catalog.PIPELINE_VERSION); results computed with others are redone
+    '''
+    return hash_key(catalog.PIPELINE_VERSION, params)
+
+
+##########---------------------------Per recording-------------------------------##############
+
+def _evaluate_cell(shared, path):
+    # one recording, in a worker process
+    warnings.simplefilter('ignore', RuntimeWarning) # all-NaN windows
+    start = time.perf_counter()
+    recording = loader.load_recording(path, shared['cache_dir'])
+    red, IR = np.asarray(recording['red']), np.asarray(recording['IR'])
+    load_sec = time.perf_counter() - start
+
+    start = time.perf_counter()
+    _, spo2, hr = catalog.estimate(red, IR, recording['sampling_rate'], **shared['params'])
+    estimate_sec = time.perf_counter() - start
+
+    row = dict(name = recording['name'], device = recording['device'], spo2 = spo2, hr = hr,
+               ref_spo2 = recording['ref_spo2'], ref_hr = recording['ref_hr'], notes = recording['notes'],
+               duration_sec = len(red)/recording['sampling_rate'], load_sec = load_sec, estimate_sec = estimate_sec)
+    row['spo2_range_error'], row['spo2_error'] = catalog.reference_error(spo2, recording['ref_spo2'])
+    row['hr_range_error'], row['hr_error'] = catalog.reference_error(hr, recording['ref_hr'])
+    return row
+
+
+##########---------------------------Dataset-------------------------------##############
+
+def evaluate(data_dir = loader.DATA_DIR, devices = ('proto1', 'proto2'), cache_dir = None, num_workers = None,
+             force = False, sec_to_avg = 3, detector = 'percentile'):
+    '''
+    One result row per recording (see COLUMNS), computing only the recordings that are new or changed since the last
+    call with the same parameters (all of them if force). num_workers: processes (default: all cores).
+    Returns the rows and the number of recordings computed.
+    '''
+    if cache_dir is None:
+        cache_dir = os.path.join(data_dir, '.cache')
+    if num_workers is None:
+        num_workers = os.cpu_count() or 1
+    params = dict(sec_to_avg = float(sec_to_avg), detector = detector)
+    key = params_key(params)
+
+    results_path = _results_path(cache_dir)
+    results = dict()
+    if os.path.exists(results_path):
+        with open(results_path) as f:
+            results = json.load(f)
+
+    paths = loader.list_recordings(data_dir, devices)
+    todo = []
+    for path in paths:
+        result = results.get(os.path.abspath(path))
+        if force or result is None or result['params'] != key or result['source'] != _source(path):
+            todo.append(path)
+
+    if todo:
+        rows = parallel.run_cells(_evaluate_cell, [(path,) for path in todo],
+                                  dict(cache_dir = cache_dir, params = params), min(num_workers, len(todo)))
+        for path, row in zip(todo, rows):
+            results[os.path.abspath(path)] = dict(row = row, params = key, source = _source(path))
+        os.makedirs(os.path.dirname(results_path), exist_ok=True)
+        loader.write_atomic(results_path, lambda f: f.write(json.dumps(results, indent=1).encode()))
+
+    rows = [results[os.path.abspath(path)]['row'] for path in paths]
+    for row in rows:
+        for name in ['ref_spo2', 'ref_hr']:
+            if row[name] is not None:
+                row[name] = tuple(row[name])
+    return rows, len(todo)
+
+
+def summary(rows):
+    '''
+    Per device: catalog.error_summary (number of recordings and mean absolute errors) and the total estimate time
+    '''
+    result = catalog.error_summary(rows)
+    for device, stats in result.items():
+        stats['estimate_sec'] = sum(row['estimate_sec'] for row in rows if row['device'] == device)
+    return result
+
+
+def _format_range(reading):
+    if reading is None:
+        return ''
+    return '%d' % reading[0] if reading[0] == reading[1] else '%d-%d' % reading
+
+
+def write_table(rows, path):
+    '''
+    Save the result rows as CSV (reference ranges as 'low-high')
+    '''
+    with open(path, 'w', newline='') as f:
+        writer = csv.DictWriter(f, COLUMNS)
+        writer.writeheader()
+        for row in rows:
+            writer.writerow(dict(row, ref_spo2 = _format_range(row['ref_spo2']), ref_hr = _format_range(row['ref_hr'])))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Estimate SpO2/HR of every recording and compare with the references')
+    parser.add_argument('--out', default='evaluation.csv', help='where to write the summary table (CSV)')
+    parser.add_argument('--data-dir', default=loader.DATA_DIR)
+    parser.add_argument('--devices', nargs='*', default=['proto1', 'proto2'])
+    parser.add_argument('--workers', type=int, help='number of processes (default: all cores)')
+    parser.add_argument('--force', action='store_true', help='recompute all recordings')
+    parser.add_argument('--sec-to-avg', type=float, default=3, help='getSpO2 averaging window (s)')
+    parser.add_argument('--detector', default='percentile', choices=['percentile', 'quantile', 'envelope'],
+                        help='get_HR peak detector')
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    rows, num_computed = evaluate(args.data_dir, args.devices, None, args.workers, args.force, args.sec_to_avg,
+                                  args.detector)
+    write_table(rows, args.out)
+    print('%d recordings (%d computed) in %.2f s -> %s' % (len(rows), num_computed, time.perf_counter() - start, args.out))
+    for device, stats in summary(rows).items():
+        print('%s: %d files, SpO2 MAE %s (%d), HR MAE %s (%d)' % (device, stats['num_files'],
+              '%.2f' % stats['mae_spo2_error'] if stats['mae_spo2_error'] is not None else '-', stats['num_spo2_error'],
+              '%.1f' % stats['mae_hr_error'] if stats['mae_hr_error'] is not None else '-', stats['num_hr_error']))
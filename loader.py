@@ -0,0 +1,251 @@
+'''
+Load the PPG recordings in spo2-data (see spo2-data/README.txt for the two file formats).
+
+Each parsed recording is cached as a binary (columns x samples) .npy file plus a small .json with the sampling rate and
+the file information, and re-opened memory-mapped. The cache entry is reused while the source file's size and mtime
+are unchanged, or if they changed but its content hash did not (e.g. after a fresh checkout).
+'''
+
+import os
+import json
+import hashlib
+import numpy as np
+
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'spo2-data')
+SAMPLING_RATES = {'proto1': 64, 'proto2': 24.995}
+CACHE_VERSION = 2
+
+
+##########---------------------------File names-------------------------------##############
+
+def _parse_range(field):
+    # '95' -> (95, 95); '9596' -> (95, 96); readings are 2 or 3 digits
+    if not field.isdigit():
+        return None
+    if len(field) in [2, 3]:
+        values = [int(field)]
+    elif len(field) == 4:
+        values = [int(field[:2]), int(field[2:])]
+    elif len(field) == 5:
+        values = [int(field[:2]), int(field[2:])]
+    elif len(field) == 6:
+        values = [int(field[:3]), int(field[3:])]
+    else:
+        return None
+    return (min(values), max(values))
+
+
+def parse_filename(path):
+    '''
+    Reference SpO2 and HR readings (as (min, max) ranges, None if absent) and notes from a recording's file name:
+    proto1 '<time>-<SpO2>-<HR>.csv' (trailing '-'/'_' marks are kept as notes), proto2
+    '<date>-<time>-<SpO2 range>-<HR range>-<notes>.csv' (e.g. '9596' = 95-96, notes 'l', 'r', 'ear-l', 'unattached').
+    '''
+    name = os.path.splitext(os.path.basename(path))[0]
+    device = _device(path)
+    core = name.rstrip('-_')
+    fields = core.split('-')
+    num_time_fields = 2 if device == 'proto2' else 1
+
+    info = dict()
+    info['name'] = name
+    info['device'] = device
+    info['time'] = '-'.join(fields[:num_time_fields])
+    fields = fields[num_time_fields:]
+
+    readings = []
+    while fields and len(readings) < 2 and _parse_range(fields[0]) is not None:
+        readings.append(_parse_range(fields.pop(0)))
+    readings += [None]*(2-len(readings))
+
+    info['ref_spo2'], info['ref_hr'] = readings
+    info['notes'] = '-'.join(fields) + name[len(core):]
+    return info
+
+
+def _device(path):
+    parent = os.path.basename(os.path.dirname(os.path.abspath(path)))
+    if parent in SAMPLING_RATES:
+        return parent
+    with open(path) as f:
+        return 'proto1' if f.readline().startswith('MAXM86161') else 'proto2'
+
+
+##########---------------------------CSV parsing-------------------------------##############
+
+def _is_number(field):
+    try:
+        float(field)
+    except ValueError:
+        return False
+    return True
+
+
+def _meta_value(value):
+    # integers (times in ms since the epoch, counts) as int, the rest as the stripped string
+    value = value.strip()
+    return int(value) if value.isdigit() else value
+
+
+def _read_proto1(path):
+    # register dumps, 'start time', 'expected tags', column names, data rows, then 'stop time' etc.
+    meta = dict()
+    columns = None
+    rows = []
+    with open(path) as f:
+        for line in f:
+            fields = line.rstrip('\n').split(',')
+            if columns is None:
+                if fields[0] == 'start time':
+                    meta['start_time'] = _meta_value(fields[1])
+                elif fields[0] == 'timestamp':
+                    columns = fields
+            elif _is_number(fields[0]):
+                rows.append(fields[:len(columns)])
+            else:
+                key, _, value = line.strip().partition(',' if ',' in line else ':')
+                meta[key.strip().replace(' ', '_')] = _meta_value(value)
+
+    def column(name):
+        idx = columns.index(name)
+        return np.array([float(row[idx]) for row in rows])
+
+    data = dict()
+    data['red'] = column('LEDC2')
+    data['IR'] = column('LEDC1')
+    data['ambient'] = column('LEDC3')
+    data['timestamp'] = column('timestamp')
+    return data, meta
+
+
+def _read_proto2(path):
+    # one header row, then IR, ambient, red (some rows have trailing empty fields)
+    rows = []
+    with open(path) as f:
+        for i, line in enumerate(f):
+            fields = line.strip().split(',')
+            if i == 0 and fields[:3] == ['1', '2', '3']:
+                continue
+            if fields and _is_number(fields[0]):
+                rows.append([float(x) for x in fields[:3]])
+    rows = np.array(rows).reshape(-1, 3)
+
+    data = dict()
+    data['red'] = rows[:,2]
+    data['IR'] = rows[:,0]
+    data['ambient'] = rows[:,1]
+    return data, dict()
+
+
+def read_csv(path):
+    '''
+    Parse one recording. Returns a dict with 'red', 'IR', 'ambient' (and 'timestamp' for proto1) arrays,
+    'sampling_rate', the parse_filename fields and 'meta' (header/trailer entries of proto1: start_time and stop_time
+    as int ms since the epoch, like the timestamps, the counts as int, other entries as strings).
+    '''
+    info = parse_filename(path)
+    if info['device'] == 'proto1':
+        data, meta = _read_proto1(path)
+    else:
+        data, meta = _read_proto2(path)
+    data['sampling_rate'] = SAMPLING_RATES[info['device']]
+    data.update(info)
+    data['meta'] = meta
+    return data
+
+
+##########---------------------------Binary cache-------------------------------##############
+
+def _file_hash(path):
+    sha = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def _cache_paths(path, cache_dir):
+    info = parse_filename(path)
+    base = os.path.join(cache_dir, info['device'], info['name'])
+    return base + '.npy', base + '.json'
+
+
+def write_atomic(path, write):
+    '''
+    Write a file by calling write(f) on a temporary file (opened 'wb') that then replaces path, so readers (and other
+    processes) never see a partial file
+    '''
+    tmp = path + '.tmp%d' % os.getpid()
+    with open(tmp, 'wb') as f:
+        write(f)
+    os.replace(tmp, path)
+
+
+def load_recording(path, cache_dir = None, mmap = True):
+    '''
+    read_csv through the binary cache (default: <data dir>/.cache). Arrays are memory-mapped read-only unless mmap = False.
+    '''
+    if cache_dir is None:
+        cache_dir = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(path))), '.cache')
+    npy_path, json_path = _cache_paths(path, cache_dir)
+    stat = os.stat(path)
+
+    meta = None
+    if os.path.exists(npy_path) and os.path.exists(json_path):
+        with open(json_path) as f:
+            meta = json.load(f)
+        source = meta['source']
+        if meta.get('version') != CACHE_VERSION:
+            meta = None
+        elif source['size'] != stat.st_size or source['mtime_ns'] != stat.st_mtime_ns:
+            if source['size'] == stat.st_size and source['sha1'] == _file_hash(path):
+                source['mtime_ns'] = stat.st_mtime_ns
+                write_atomic(json_path, lambda f: f.write(json.dumps(meta).encode()))
+            else:
+                meta = None
+
+    if meta is None:
+        data = read_csv(path)
+        columns = [key for key in ['red', 'IR', 'ambient', 'timestamp'] if key in data]
+        meta = {key: value for key, value in data.items() if key not in columns}
+        meta['columns'] = columns
+        meta['version'] = CACHE_VERSION
+        meta['source'] = dict(path = os.path.abspath(path), size = stat.st_size, mtime_ns = stat.st_mtime_ns, sha1 = _file_hash(path))
+        os.makedirs(os.path.dirname(npy_path), exist_ok=True)
+        write_atomic(npy_path, lambda f: np.save(f, np.stack([data[key] for key in columns])))
+        write_atomic(json_path, lambda f: f.write(json.dumps(meta).encode()))
+
+    table = np.load(npy_path, mmap_mode='r' if mmap else None)
+    recording = {key: value for key, value in meta.items() if key not in ['columns', 'version', 'source']}
+    for i, key in enumerate(meta['columns']):
+        recording[key] = table[i]
+    for key in ['ref_spo2', 'ref_hr']:
+        if recording[key] is not None:
+            recording[key] = tuple(recording[key])
+    recording['path'] = path
+    return recording
+
+
+def list_recordings(data_dir = DATA_DIR, devices = ('proto1', 'proto2')):
+    '''
+    Paths of the .csv recordings under data_dir/<device>, sorted by name
+    '''
+    paths = []
+    for device in devices:
+        device_dir = os.path.join(data_dir, device)
+        paths += sorted(os.path.join(device_dir, f) for f in os.listdir(device_dir) if f.endswith('.csv'))
+    return paths
+
+
+def load_dataset(data_dir = DATA_DIR, devices = ('proto1', 'proto2'), cache_dir = None):
+    '''
+    load_recording for every recording, as a dict keyed by file name (without .csv)
+    '''
+    if cache_dir is None:
+        cache_dir = os.path.join(data_dir, '.cache')
+    recordings = dict()
+    for path in list_recordings(data_dir, devices):
+        recording = load_recording(path, cache_dir)
+        recordings[recording['name']] = recording
+    return recordings
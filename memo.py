@@ -0,0 +1,241 @@
+'''
+Opt-in memoization of the pure util stages (decompose_ACDC, getSpO2, synth_HR, resample_hr).
+
+Results are keyed on a hash of the array contents and parameters, so the same recording or synthetic signal passed
+again (even as a different array object) is a hit. Cached results are kept in an in-memory LRU limited in bytes and,
+optionally, in a directory on disk limited in bytes too (least recently used files are removed first). Callers always
+get their own copy of a cached result, so modifying it does not affect the cache.
+
+    memo.enable(max_bytes = 512*2**20, disk_dir = 'spo2-data/.cache/memo')
+    ...
+    memo.stats()  # {'hits': ..., 'disk_hits': ..., 'misses': ..., ...}
+
+Nothing is cached until enable is called. Objects with a content_key() method (e.g. util.TiledSignal) are hashed by
+the value it returns; other arguments that cannot be hashed by content bypass the cache.
+'''
+
+import os
+import pickle
+import hashlib
+import inspect
+import functools
+import collections
+import numpy as np
+
+
+_cache = None
+
+
+##########---------------------------Hashing-------------------------------##############
+
+class _Unhashable(Exception):
+    pass
+
+
+def _update_hash(sha, value):
+    if isinstance(value, np.ndarray):
+        if value.dtype.hasobject:
+            raise _Unhashable('object array')
+        sha.update(b'a' + value.dtype.str.encode() + repr(value.shape).encode())
+        sha.update(np.ascontiguousarray(value).reshape(-1).view(np.uint8))
+    elif isinstance(value, (tuple, list)):
+        sha.update(b'l%d' % len(value))
+        for item in value:
+            _update_hash(sha, item)
+    elif isinstance(value, dict):
+        sha.update(b'd%d' % len(value))
+        for key in sorted(value, key=repr):
+            _update_hash(sha, key)
+            _update_hash(sha, value[key])
+    elif value is None or isinstance(value, (bool, int, float, str, bytes, np.generic)):
+        sha.update(type(value).__name__.encode() + repr(value).encode())
+    elif hasattr(value, 'to_numpy'): # pandas Series, as the demo passes to decompose_ACDC
+        sha.update(type(value).__name__.encode())
+        _update_hash(sha, value.to_numpy())
+    elif hasattr(value, 'content_key'): # objects defined by a few parameters, e.g. util.TiledSignal
+        sha.update(b'k' + type(value).__name__.encode())
+        _update_hash(sha, value.content_key())
+    elif isinstance(value, type):
+        sha.update(b't' + value.__module__.encode() + value.__qualname__.encode())
+    else:
+        raise _Unhashable(type(value).__name__)
+
+
+def hash_key(*values):
+    '''
+    Hex digest of the contents of values (numpy arrays, numbers, strings, objects with a content_key() method, and
+    tuples/lists/dicts of those)
+    '''
+    sha = hashlib.blake2b(digest_size=20)
+    for value in values:
+        _update_hash(sha, value)
+    return sha.hexdigest()
+
+
+def _copy(value):
+    if isinstance(value, np.ndarray):
+        return np.array(value)
+    if isinstance(value, dict):
+        return {key: _copy(item) for key, item in value.items()}
+    if isinstance(value, (tuple, list)):
+        return type(value)(_copy(item) for item in value)
+    return value
+
+
+def _nbytes(value):
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if isinstance(value, dict):
+        return sum(_nbytes(item) for item in value.values())
+    if isinstance(value, (tuple, list)):
+        return sum(_nbytes(item) for item in value)
+    return 0
+
+
+##########---------------------------Cache-------------------------------##############
+
+class Cache:
+    '''
+    In-memory LRU of at most max_bytes (array bytes) with an optional disk tier in disk_dir of at most max_disk_bytes.
+    '''
+    def __init__(self, max_bytes = 256*2**20, disk_dir = None, max_disk_bytes = 2**30):
+        self.max_bytes = max_bytes
+        self.disk_dir = disk_dir
+        self.max_disk_bytes = max_disk_bytes
+        self.entries = collections.OrderedDict()
+        self.bytes = 0
+        self.counts = dict(hits = 0, disk_hits = 0, misses = 0, bypassed = 0, evictions = 0, disk_evictions = 0)
+        if disk_dir is not None:
+            os.makedirs(disk_dir, exist_ok=True)
+
+    def _disk_path(self, key):
+        return os.path.join(self.disk_dir, key + '.pkl')
+
+    def get(self, key):
+        '''
+        Cached value for key, or None
+        '''
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            self.counts['hits'] += 1
+            return self.entries[key]
+        if self.disk_dir is not None and os.path.exists(self._disk_path(key)):
+            path = self._disk_path(key)
+            try:
+                with open(path, 'rb') as f:
+                    value = pickle.load(f)
+            except (OSError, EOFError, pickle.UnpicklingError):
+                value = None
+            if value is not None:
+                os.utime(path) # mark as recently used for the disk eviction
+                self.counts['disk_hits'] += 1
+                self._put_memory(key, value)
+                return value
+        self.counts['misses'] += 1
+        return None
+
+    def put(self, key, value):
+        self._put_memory(key, value)
+        if self.disk_dir is not None:
+            path = self._disk_path(key)
+            tmp = path + '.tmp%d' % os.getpid()
+            with open(tmp, 'wb') as f:
+                pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp, path)
+            self._evict_disk()
+
+    def _put_memory(self, key, value):
+        size = _nbytes(value)
+        if size > self.max_bytes:
+            return
+        if key in self.entries:
+            self.bytes -= _nbytes(self.entries.pop(key))
+        self.entries[key] = value
+        self.bytes += size
+        while self.bytes > self.max_bytes:
+            _, evicted = self.entries.popitem(last=False)
+            self.bytes -= _nbytes(evicted)
+            self.counts['evictions'] += 1
+
+    def _evict_disk(self):
+        files = []
+        for name in os.listdir(self.disk_dir):
+            if name.endswith('.pkl'):
+                stat = os.stat(os.path.join(self.disk_dir, name))
+                files.append((stat.st_mtime, stat.st_size, name))
+        total = sum(size for _, size, _ in files)
+        for _, size, name in sorted(files):
+            if total <= self.max_disk_bytes:
+                break
+            os.remove(os.path.join(self.disk_dir, name))
+            total -= size
+            self.counts['disk_evictions'] += 1
+
+    def clear(self, disk = False):
+        self.entries.clear()
+        self.bytes = 0
+        if disk and self.disk_dir is not None:
+            for name in os.listdir(self.disk_dir):
+                if name.endswith('.pkl'):
+                    os.remove(os.path.join(self.disk_dir, name))
+
+    def stats(self):
+        stats = dict(self.counts)
+        stats['entries'] = len(self.entries)
+        stats['bytes'] = self.bytes
+        return stats
+
+
+def enable(max_bytes = 256*2**20, disk_dir = None, max_disk_bytes = 2**30):
+    '''
+    Start caching the memoized functions (replaces any previous cache). Returns the Cache.
+    '''
+    global _cache
+    _cache = Cache(max_bytes, disk_dir, max_disk_bytes)
+    return _cache
+
+
+def disable():
+    global _cache
+    _cache = None
+
+
+def stats():
+    '''
+    Hit/miss counts and memory use of the current cache (None if caching is disabled)
+    '''
+    return None if _cache is None else _cache.stats()
+
+
+def clear(disk = False):
+    if _cache is not None:
+        _cache.clear(disk)
+
+
+def memoize(func):
+    '''
+    Decorator: when caching is enabled, return a copy of the cached result of func for the same argument values
+    (defaults included) instead of calling it. func must be pure and return arrays, numbers, or tuples/dicts of those.
+    '''
+    signature = inspect.signature(func)
+    name = func.__module__ + '.' + func.__qualname__
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if _cache is None:
+            return func(*args, **kwargs)
+        bound = signature.bind(*args, **kwargs)
+        bound.apply_defaults()
+        try:
+            key = hash_key(name, list(bound.arguments.items()))
+        except _Unhashable:
+            _cache.counts['bypassed'] += 1
+            return func(*args, **kwargs)
+
+        value = _cache.get(key)
+        if value is None:
+            value = func(*args, **kwargs)
+            _cache.put(key, _copy(value))
+            return value
+        return _copy(value)
+    return wrapper
@@ -0,0 +1,144 @@
+'''
+Run the independent cells of a parameter sweep across a process pool.
+
+The large arrays every cell reads (e.g. data_synth) are copied once into shared memory when the workers start
+instead of being pickled with every cell. Each cell reseeds np.random from its own stream, spawned from a single seed,
+so the results are the same whatever the number of workers.
+'''
+
+import numpy as np
+import multiprocessing as mp
+import profiling
+
+
+_shared = None
+_cell_func = None
+_profile = False
+
+
+def _to_shared(data):
+    # numpy arrays go into shared memory, anything else (sampling rate, tile range, ...) is passed as is
+    spec = dict()
+    for key, value in data.items():
+        if isinstance(value, np.ndarray):
+            raw = mp.RawArray('b', max(value.nbytes, 1))
+            np.frombuffer(raw, dtype=value.dtype, count=value.size)[:] = value.ravel()
+            spec[key] = ('array', raw, value.dtype, value.shape)
+        else:
+            spec[key] = ('value', value)
+    return spec
+
+
+def _from_shared(spec):
+    data = dict()
+    for key, item in spec.items():
+        if item[0] == 'array':
+            _, raw, dtype, shape = item
+            data[key] = np.frombuffer(raw, dtype=dtype, count=int(np.prod(shape))).reshape(shape)
+        else:
+            data[key] = item[1]
+    return data
+
+
+def _init_worker(cell_func, spec, profile):
+    global _shared, _cell_func, _profile
+    _shared = _from_shared(spec)
+    _cell_func = cell_func
+    _profile = profile
+    if profile:
+        profiling.enable(*profile)
+
+
+def _call_cell(cell_func, shared, cell):
+    with profiling.region(cell_func.__module__ + '.' + cell_func.__name__, cell = cell):
+        return cell_func(shared, *cell)
+
+
+def _run_cell(job):
+    cell_seed, cell = job
+    np.random.seed(cell_seed)
+    result = _call_cell(_cell_func, _shared, cell)
+    if _profile:
+        # the worker's records go back with the result and are merged by run_cells
+        return result, profiling.take()
+    return result
+
+
+def _run_indexed(job):
+    i, job = job
+    return i, _run_cell(job)
+
+
+def cell_seeds(num_cells, seed = None):
+    '''
+    One independent seed per cell, spawned from seed (np.random.SeedSequence).
+    '''
+    children = np.random.SeedSequence(seed).spawn(num_cells)
+    return [int(child.generate_state(1)[0]) for child in children]
+
+
+def _key_seed(key):
+    # seed of a stored cell, from its (hex) key
+    return int(key[:8], 16)
+
+
+def _iter_results(cell_func, jobs, shared, num_workers):
+    # (position, result) of each (cell_seed, cell) job as it completes, in this process if num_workers is None or 1
+    if num_workers is None or num_workers == 1:
+        state = np.random.get_state()
+        try:
+            for i, (cell_seed, cell) in enumerate(jobs):
+                np.random.seed(cell_seed)
+                yield i, _call_cell(cell_func, shared, cell)
+        finally:
+            np.random.set_state(state)
+        return
+
+    profile = (profiling._memory, profiling._max_events) if profiling.enabled() else None
+    with mp.Pool(num_workers, initializer=_init_worker, initargs=(cell_func, _to_shared(shared), profile)) as pool:
+        for i, result in pool.imap_unordered(_run_indexed, list(enumerate(jobs))):
+            if profile:
+                result, collected = result
+                profiling.merge(collected)
+            yield i, result
+
+
+def _run_stored(cell_func, cells, shared, num_workers, seed, store, keys):
+    if keys is None:
+        fingerprint = store.fingerprint(shared)
+        keys = [(fingerprint, cell) for cell in cells]
+    keys = [store.cell_key(cell_func, key, seed) for key in keys]
+    results = [store.get(key) for key in keys]
+    todo = [i for i, result in enumerate(results) if result is None]
+    jobs = [(_key_seed(keys[i]), cells[i]) for i in todo]
+    # checkpoint every cell as soon as it is done
+    for j, result in _iter_results(cell_func, jobs, shared, num_workers):
+        store.put(keys[todo[j]], result)
+        results[todo[j]] = result
+    return results
+
+
+def run_cells(cell_func, cells, shared, num_workers = None, seed = None, store = None, keys = None):
+    '''
+    Return [cell_func(shared, *cell) for cell in cells].
+    cell_func must be a module level function so it can be sent to the workers; shared is a dict.
+
+    num_workers = None runs the cells in order in this process with the global np.random state, exactly like a plain
+    loop. Otherwise every cell reseeds np.random from cell_seeds(len(cells), seed) and the cells are spread over
+    num_workers processes (num_workers = 1 runs them here); results only depend on seed, not on num_workers.
+
+    store (sweepstore.SweepStore): results already in the store are not computed again, and each computed cell is saved
+    as it completes. Cells are identified by keys (one hashable description per cell that determines its result;
+    default: a fingerprint of shared and the cell) and seed, and reseed np.random from their key.
+    '''
+    cells = list(cells)
+    if store is not None:
+        return _run_stored(cell_func, cells, shared, num_workers, seed, store, keys)
+    if num_workers is None:
+        return [_call_cell(cell_func, shared, cell) for cell in cells]
+
+    jobs = list(zip(cell_seeds(len(cells), seed), cells))
+    results = [None]*len(jobs)
+    for i, result in _iter_results(cell_func, jobs, shared, num_workers):
+        results[i] = result
+    return results
@@ -1,7 +1,9 @@
+import os
 import numpy as np
 import matplotlib.pyplot as plt
 from matplotlib.colors import TwoSlopeNorm
 import util
+import parallel
 
 
 '''
@@ -68,52 +70,201 @@ params_quick_recov['drop_frac'] = 0.60
 '''
 
 
+##########---------------------------Rendering-------------------------------##############
+
+# opt-in downsampling of long traces (set_downsampling) and saving instead of plt.show (render, render_batch)
+_max_points = None
+_method = 'minmax'
+_output = None
+
+
+def set_downsampling(max_points = 4000, method = 'minmax'):
+    '''
+    Plot at most about max_points points of each long trace, keeping its shape: 'minmax' keeps the minimum and maximum
+    of every bin (no peak or dip is lost), 'lttb' picks one point per bin by largest triangle three buckets. Only the
+    visible time range is downsampled. max_points = None plots every sample (the default).
+    '''
+    global _max_points, _method
+    if method not in ['minmax', 'lttb']:
+        raise ValueError('method must be minmax or lttb')
+    _max_points = max_points
+    _method = method
+
+
+def minmax_downsample(x, y, max_points):
+    '''
+    x, y reduced to the minimum and maximum of y (in their original order) in each of max_points//2 bins
+    '''
+    N = len(y)
+    if N <= max_points:
+        return x, y
+    bin_len = int(np.ceil(N/(max_points//2)))
+    num_bins = int(np.ceil(N/bin_len))
+    padded = np.full(num_bins*bin_len, float('nan'))
+    padded[:N] = y
+    padded = padded.reshape(num_bins, bin_len)
+    # NaN bins (e.g. before the rolling average starts) keep their first sample, so gaps stay gaps
+    lows = np.argmin(np.where(np.isnan(padded), np.inf, padded), axis=1)
+    highs = np.argmax(np.where(np.isnan(padded), -np.inf, padded), axis=1)
+    starts = np.arange(num_bins)*bin_len
+    idx = np.unique(np.minimum(np.concatenate([starts + lows, starts + highs]), N-1))
+    return x[idx], y[idx]
+
+
+def lttb_downsample(x, y, max_points):
+    '''
+    x, y reduced to max_points points by largest triangle three buckets (first and last point kept)
+    '''
+    N = len(y)
+    if N <= max_points or max_points < 3:
+        return x, y
+    edges = np.linspace(1, N-1, max_points-1).astype(int)
+    idx = np.zeros(max_points, dtype=int)
+    idx[-1] = N-1
+    y_filled = np.where(np.isnan(y), np.nanmean(y), y)
+    for b in range(max_points-2):
+        start, stop = edges[b], max(edges[b+1], edges[b]+1)
+        # the next bucket's average (or the last point) is the third corner
+        if b < max_points-3:
+            next_x = np.mean(x[edges[b+1]:edges[b+2]])
+            next_y = np.mean(y_filled[edges[b+1]:edges[b+2]])
+        else:
+            next_x, next_y = x[N-1], y_filled[N-1]
+        prev_x, prev_y = x[idx[b]], y_filled[idx[b]]
+        area = np.abs((prev_x - next_x)*(y_filled[start:stop] - prev_y) - (prev_x - x[start:stop])*(next_y - prev_y))
+        idx[b+1] = start + np.argmax(area)
+    return x[idx], y[idx]
+
+
+def _visible(x, y, xlim):
+    # samples within xlim (x ascending), plus one on each side so lines run to the axes edges
+    start = max(np.searchsorted(x, xlim[0]) - 1, 0)
+    stop = np.searchsorted(x, xlim[1], side='right') + 1
+    return x[start:stop], y[start:stop]
+
+
+def _plot(ax, x, y, *args, xlim = None, **kwargs):
+    # ax.plot, downsampled to the visible range when set_downsampling is on
+    x, y = np.asarray(x), np.asarray(y)
+    if _max_points is not None:
+        if xlim is not None:
+            x, y = _visible(x, y, xlim)
+        downsample = minmax_downsample if _method == 'minmax' else lttb_downsample
+        x, y = downsample(x, y, _max_points)
+    return ax.plot(x, y, *args, **kwargs)
+
+
+def _show():
+    # plt.show, or while rendering to files save and close the figures opened since render was called
+    if _output is None:
+        plt.show()
+        return
+    for num in plt.get_fignums():
+        if num in _output['existing']:
+            continue
+        path = '%s_%d.%s' % (_output['prefix'], len(_output['paths']) + 1, _output['format'])
+        plt.figure(num).savefig(path, dpi=_output['dpi'], bbox_inches='tight')
+        _output['paths'].append(path)
+        plt.close(num)
+
+
+def render(func, args, kwargs = None, prefix = 'figure', format = 'png', dpi = 100):
+    '''
+    Call the plotting function func(*args, **kwargs) saving its figures as <prefix>_1.<format>, <prefix>_2.<format>, ...
+    instead of showing them. Returns the paths. Figures open before the call are left alone.
+    '''
+    global _output
+    _output = dict(prefix = prefix, format = format, dpi = dpi, paths = [], existing = set(plt.get_fignums()))
+    try:
+        func(*args, **(kwargs or dict()))
+        _show() # figures left open (e.g. plot_dur_vs_HR's last one)
+        return _output['paths']
+    finally:
+        _output = None
+
+
+def _render_cell(shared, name, func, args, kwargs):
+    set_downsampling(shared['max_points'], shared['method'])
+    return render(func, args, kwargs, os.path.join(shared['out_dir'], name), shared['format'], shared['dpi'])
+
+
+def render_batch(jobs, out_dir, num_workers = None, format = 'png', dpi = 100, max_points = 4000, method = 'minmax'):
+    '''
+    Render a batch of figures to files with the Agg backend (no display needed), spread over num_workers processes
+    (see parallel.run_cells; None renders them here). jobs: (name, func, args, kwargs) tuples; the figures of each are
+    saved as out_dir/<name>_1.<format>, ... Pass precomputed data_synth(s) in kwargs so figures do not re-synthesize.
+    Traces are downsampled (set_downsampling(max_points, method)). Returns the list of paths of each job.
+    '''
+    os.makedirs(out_dir, exist_ok=True)
+    backend = plt.get_backend()
+    downsampling = (_max_points, _method)
+    plt.switch_backend('Agg')
+    try:
+        shared = dict(out_dir = out_dir, format = format, dpi = dpi, max_points = max_points, method = method)
+        return parallel.run_cells(_render_cell, jobs, shared, num_workers)
+    finally:
+        set_downsampling(*downsampling)
+        plt.switch_backend(backend)
+
+
 ##########---------------------------Simple plots-------------------------------##############
 def plot_raw_data(data):
     fig, axs = plt.subplots(3, 1)
     plt.rcParams['font.size'] = '12'
     fig.set_figheight(10)
-    axs[0].plot(data['time_min'], data['IR'])
+    _plot(axs[0], data['time_min'], data['IR'])
     axs[0].set_ylabel('infrared signal (normalized)')
 
 
-    axs[1].plot(data['time_min'], data['IR_AC'])
+    _plot(axs[1], data['time_min'], data['IR_AC'])
     axs[1].set_ylabel('AC component')
 
 
-    axs[2].plot(data['time_min'], data['IR_DC'])
+    _plot(axs[2], data['time_min'], data['IR_DC'])
     axs[2].set_xlabel('time (minutes)')
     axs[2].set_ylabel('DC component')
 
 
-    plt.show()
+    _show()
 
 def plot_nyquest(fq_of_interest, data_label):
     min_sampling_Hz = (2*fq_of_interest)/60
     plt.plot(fq_of_interest, min_sampling_Hz)
     plt.ylabel('minimum sampling rate (Hz)')
     plt.xlabel(data_label)
-    plt.show()
+    _show()
 
 ##########---------------------------Mimic Sun et al Plots-------------------------------##############
-def plot_synth_spo2(data, params, marker, data_label='', plot_line = True):
-
-    data_synth = util.synthesize_SpO2(data, params)
+def plot_synth_spo2(data, params, marker, data_label='', plot_line = True, data_synth = None, xlim = None, reading_every = 500):
+    '''
+    data_synth: precomputed util.synthesize_SpO2(data, params), so it is not synthesized again
+    The trace (plot_line) is drawn in full, downsampled to xlim when set_downsampling is on; marker shows one reading
+    every reading_every samples, like the discrete measurements of Sun et al.
+    '''
+    if data_synth is None:
+        data_synth = util.synthesize_SpO2(data, params)
+    ax = plt.gca()
     t = data_synth['time_min'] - data_synth['time_min'][data_synth['drop_idx']]
     time2plot = t<30
+    t = t[time2plot]
+    spo2 = data_synth['spo2'][time2plot]
     if plot_line:
-        plt.plot(t[time2plot][1::500], data_synth['spo2'][time2plot][1::500],'k')
-    plt.plot(t[time2plot][1::500], data_synth['spo2'][time2plot][1::500], marker, label = data_label)
+        _plot(ax, t, spo2, 'k', xlim = xlim)
+    _plot(ax, t[1::reading_every], spo2[1::reading_every], marker, label = data_label, xlim = xlim)
     
     
-def plot_fig_1(data, params_ctrl, params_pph_avg, params_pph_noshunt):
+def plot_fig_1(data, params_ctrl, params_pph_avg, params_pph_noshunt, data_synths = (None, None, None)):
+    '''
+    data_synths: precomputed synthesize_SpO2 outputs for the three params (or None to synthesize), as for plot_fig_2/3
+    '''
     plt.figure()
-    plot_synth_spo2(data, params_ctrl,'ko',data_label = 'Control')
-    plot_synth_spo2(data, params_pph_avg,'ks',data_label = 'Shunt-PPH')
-    plot_synth_spo2(data, params_pph_noshunt,'kx',data_label = 'No-Shunt-PPH')
+    xlim = (-3,6)
+    plot_synth_spo2(data, params_ctrl,'ko',data_label = 'Control', data_synth = data_synths[0], xlim = xlim)
+    plot_synth_spo2(data, params_pph_avg,'ks',data_label = 'Shunt-PPH', data_synth = data_synths[1], xlim = xlim)
+    plot_synth_spo2(data, params_pph_noshunt,'kx',data_label = 'No-Shunt-PPH', data_synth = data_synths[2], xlim = xlim)
     plt.legend()
     ax = plt.gca()
-    ax.set_xlim(-3,6)
+    ax.set_xlim(*xlim)
     ax.set_ylim(80,100)
     ax.set_yticks(np.arange(80,101,5))
     ax.set_xticks(np.arange(-3,18,3))
@@ -125,16 +276,17 @@ def plot_fig_1(data, params_ctrl, params_pph_avg, params_pph_noshunt):
     plt.title('Average across participants')
 
 
-    plt.show()
+    _show()
     
     
-def plot_fig_2(data, params_ctrl_indi, params_pph_noshunt_indi, params_pph_indi):
+def plot_fig_2(data, params_ctrl_indi, params_pph_noshunt_indi, params_pph_indi, data_synths = (None, None, None)):
     plt.figure()
-    plot_synth_spo2(data, params_ctrl_indi,'k:', data_label = 'Control',plot_line = False)
-    plot_synth_spo2(data, params_pph_noshunt_indi,'k--', data_label = 'No-Shunt-PPH',plot_line = False)
-    plot_synth_spo2(data, params_pph_indi,'k', data_label = 'Shunt-PPH',plot_line = False)
+    xlim = (-1,4)
+    plot_synth_spo2(data, params_ctrl_indi,'k:', data_label = 'Control',plot_line = False, data_synth = data_synths[0], xlim = xlim)
+    plot_synth_spo2(data, params_pph_noshunt_indi,'k--', data_label = 'No-Shunt-PPH',plot_line = False, data_synth = data_synths[1], xlim = xlim)
+    plot_synth_spo2(data, params_pph_indi,'k', data_label = 'Shunt-PPH',plot_line = False, data_synth = data_synths[2], xlim = xlim)
     ax = plt.gca()
-    ax.set_xlim(-1,4)
+    ax.set_xlim(*xlim)
     ax.set_ylim(85,100)
     ax.set_yticks(np.arange(85,101,5))
     ax.set_xticks(np.arange(-1,4,1))
@@ -145,13 +297,14 @@ def plot_fig_2(data, params_ctrl_indi, params_pph_noshunt_indi, params_pph_indi)
     plt.ylabel('SpO2 (%)')
     plt.title('Individual participants')
     plt.legend()
-    plt.show()
+    _show()
 
-def plot_fig_3(data, params_quick_recov):
+def plot_fig_3(data, params_quick_recov, data_synth = None):
     plt.figure()
-    plot_synth_spo2(data, params_quick_recov,'ks')
+    xlim = (-3,3)
+    plot_synth_spo2(data, params_quick_recov,'ks', data_synth = data_synth, xlim = xlim)
     ax = plt.gca()
-    ax.set_xlim(-3,3)
+    ax.set_xlim(*xlim)
     ax.set_ylim(80,100)
     ax.set_yticks(np.arange(80,101,5))
     ax.set_xticks(np.arange(-10.5,2,3))
@@ -163,30 +316,35 @@ def plot_fig_3(data, params_quick_recov):
     plt.ylabel('SpO2 (%)')
     plt.title('Late-developing, quick recovery')
 
-    plt.show()
+    _show()
 
 
-def plot_color_range(data, params, data_rate_green_sec, green_range, orange_range, red_thresh):
+def plot_color_range(data, params, data_rate_green_sec, green_range, orange_range, red_thresh, data_synth = None):
+    '''
+    data_synth: precomputed util.synthesize_SpO2(data, params), so it is not synthesized again
+    '''
+    plt.figure()
     ax = plt.gca()
-    data_synth = util.synthesize_SpO2(data, params)
+    t_lims = [-5,6]
+    if data_synth is None:
+        data_synth = util.synthesize_SpO2(data, params)
     t = data_synth['time_min'] - data_synth['time_min'][data_synth['drop_idx']]
 
     spo2 = data_synth['spo2']
     time2plot = t<15
     t = t[time2plot]
     spo2 =spo2[time2plot]
-    plt.plot(t, spo2,'k')
+    _plot(ax, t, spo2,'k', xlim = t_lims)
 
     green = t[spo2>green_range[0]]
     green_spo2 = spo2[spo2>green_range[0]]
     sampling_period = int(data_synth['sampling_rate']*data_rate_green_sec*60)
-    plt.plot(green[::sampling_period], green_spo2[::sampling_period], 'gx')
+    _plot(ax, green[::sampling_period], green_spo2[::sampling_period], 'gx', xlim = t_lims)
 
     orange = t[spo2<green_range[0]]
     orange_spo2 = spo2[spo2<green_range[0]]
-    plt.plot(orange, orange_spo2, color = '#FCA103',marker = 'x')
+    _plot(ax, orange, orange_spo2, color = '#FCA103',marker = 'x', xlim = t_lims)
     
-    t_lims = [-5,6]
     ymin = 85
     ax.set_xlim(t_lims[0],t_lims[1])
     ax.set_xticks(np.arange(t_lims[0],t_lims[1],5))
@@ -205,7 +363,7 @@ def plot_color_range(data, params, data_rate_green_sec, green_range, orange_rang
     ax.fill_between(t_lims,[red_thresh, red_thresh], [ymin,ymin],color = 'r',alpha = .2)
     
     
-    plt.show()
+    _show()
 
 
 ##########---------------------------analysis plots-------------------------------##############
@@ -228,7 +386,7 @@ def plot_fq_vs_HR(pct_error, target_HRs, resampled_rates):
     plt.ylabel('sampling frequency (Hz)')
     plt.clim(0,10)
 
-    plt.show()
+    _show()
     
     fig, axs = plt.subplots(2, 1)
     plt.rcParams['font.size'] = '12'
@@ -255,7 +413,7 @@ def plot_fq_vs_HR(pct_error, target_HRs, resampled_rates):
     axs[1].axhline(color = 'k',linestyle = '--', y=2.4)
     axs[1].axvline(color = 'k',linestyle = '--', x=18)
     
-    plt.show()
+    _show()
 
 def plot_dur_vs_HR(pct_error, target_HRs, sample_durs):
     plt.imshow(pct_error.T)
@@ -275,7 +433,7 @@ def plot_dur_vs_HR(pct_error, target_HRs, sample_durs):
     plt.clim(0,10)
     plt.xlabel('heart rate (BPM)')
     plt.ylabel('sample duration (sec)')
-    plt.show()
+    _show()
 
     fig, axs = plt.subplots(2, 1)
     plt.rcParams['font.size'] = '12'
@@ -318,7 +476,7 @@ def plot_rate_vs_alarm_time(alarm_times_sec,alarm_times_stds, inter_sample_sec,
     plt.colorbar(label='warning delay (sec)')
     plt.xlabel('inter sample space (sec)')
     plt.ylabel('trigger threshold')
-    plt.show()
+    _show()
 
     plt.figure()
     times = np.nanmean(alarm_times_sec,0)
@@ -335,7 +493,24 @@ def plot_rate_vs_alarm_time(alarm_times_sec,alarm_times_stds, inter_sample_sec,
     ax.axvline(color = 'k',linestyle = '--', x=30)
     ax.axhline(color = 'k',linestyle = '--', y=30)
     plt.ylabel('warning time delay (sec)')
-    plt.show()
+    _show()
+
+
+def plot_stored(store, name):
+    '''
+    Plot the results of sweep name ('samplingFq_vs_HR', 'samplingDur_vs_HR' or 'inter_sample_vs_alarm_time') last
+    saved in store (sweepstore.SweepStore), with plot_fq_vs_HR, plot_dur_vs_HR or plot_rate_vs_alarm_time
+    '''
+    axes, results = store.load_grid(name)
+    if name == 'samplingFq_vs_HR':
+        plot_fq_vs_HR(results['results_error'], axes['target_HRs'], axes['resampled_rates'])
+    elif name == 'samplingDur_vs_HR':
+        plot_dur_vs_HR(results['results_error'], axes['target_HRs'], axes['sample_durs'])
+    elif name == 'inter_sample_vs_alarm_time':
+        plot_rate_vs_alarm_time(results['alarm_times_sec'], results['alarm_times_stds'], axes['inter_sample_sec'],
+                                axes['spo2_thresh'])
+    else:
+        raise ValueError('no plot for sweep %s' % name)
 
 
 def plot_fraction_batt_vs_orange_time(results, inter_sample_sec, prcile_orange):
@@ -368,7 +543,7 @@ def plot_fraction_batt_vs_orange_time(results, inter_sample_sec, prcile_orange):
     fig.colorbar(cax, label='fraction battery use', ticks = np.arange(0,1.1,.25),fraction=0.03, pad=0.04)
 
 
-    plt.show()
+    _show()
 
 
     plt.plot(poriton_label, results[:,prcile_orange==.5],label = '50%',color = '#FCA103', linewidth = 4)
@@ -385,7 +560,7 @@ def plot_fraction_batt_vs_orange_time(results, inter_sample_sec, prcile_orange):
     plt.ylabel('fraction battery use')
     plt.title('Fraction battery use vs % time in orange range')
     plt.legend()
-    plt.show()
+    _show()
 
 
 def plot_battery_life_in_days(results, multiplier, inter_sample_sec, prcile_orange, plot_title):
@@ -423,7 +598,7 @@ def plot_battery_life_in_days(results, multiplier, inter_sample_sec, prcile_oran
     cbar.ax.set_yticklabels(['0', '1', '2','>3'])  # vertically oriented colorbar
 
     plt.title(plot_title)
-    plt.show()
+    _show()
     
     max_bat = np.max(results_batty[:,prcile_orange==.2])
     max_bat = np.ceil(max_bat/.5)*.5
@@ -445,5 +620,5 @@ def plot_battery_life_in_days(results, multiplier, inter_sample_sec, prcile_oran
     plt.ylabel('Battery life (days)')
     plt.title('Battery life (days) vs % time in orange range')
     plt.legend()
-    plt.show()
+    _show()
     
@@ -0,0 +1,209 @@
+'''
+Opt-in instrumentation of the util and analysis stages and of the sweep cells.
+
+Instrumented functions record their call count, cumulative and maximum wall time and the bytes of the arrays passed in
+and returned; with memory = True also the net memory they allocated (tracemalloc, slow). Every call is also kept as a
+trace event, which write_trace saves in the Chrome trace format (chrome://tracing, https://ui.perfetto.dev).
+Cells run by parallel.run_cells in worker processes are recorded there and merged back.
+
+    profiling.enable()
+    analysis.inter_sample_vs_alarm_time(...)
+    print(profiling.format_table())
+    profiling.write_trace('sweep.json')
+
+When disabled (the default) an instrumented function only costs one extra call and a flag check.
+Times are inclusive: a stage's time includes the stages it calls.
+'''
+
+import os
+import csv
+import json
+import time
+import functools
+import threading
+import contextlib
+import tracemalloc
+import numpy as np
+
+
+_enabled = False
+_memory = False
+_max_events = 10**6
+_records = dict()
+_events = []
+
+
+def enable(memory = False, max_events = 10**6):
+    '''
+    Start recording (clears earlier records). memory = True also traces allocations; max_events bounds the trace.
+    '''
+    global _enabled, _memory, _max_events
+    reset()
+    _enabled = True
+    _memory = memory
+    _max_events = max_events
+    if memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+
+
+def disable():
+    global _enabled, _memory
+    if _memory and tracemalloc.is_tracing():
+        tracemalloc.stop()
+    _enabled = False
+    _memory = False
+
+
+def enabled():
+    return _enabled
+
+
+def reset():
+    _records.clear()
+    del _events[:]
+
+
+##########---------------------------Recording-------------------------------##############
+
+def _array_bytes(values):
+    # bytes of the numpy arrays among values, looking one level into dicts, tuples and lists (e.g. h, hr_synth)
+    total = 0
+    for value in values:
+        if isinstance(value, np.ndarray):
+            total += value.nbytes
+        elif isinstance(value, dict):
+            total += sum(v.nbytes for v in value.values() if isinstance(v, np.ndarray))
+        elif isinstance(value, (tuple, list)):
+            total += sum(v.nbytes for v in value if isinstance(v, np.ndarray))
+    return total
+
+
+def _record(name, start, duration, in_bytes, out_bytes, traced_bytes, args):
+    record = _records.get(name)
+    if record is None:
+        record = _records[name] = dict(calls = 0, total_sec = 0., max_sec = 0., in_bytes = 0, out_bytes = 0, traced_bytes = 0)
+    record['calls'] += 1
+    record['total_sec'] += duration
+    record['max_sec'] = max(record['max_sec'], duration)
+    record['in_bytes'] += in_bytes
+    record['out_bytes'] += out_bytes
+    record['traced_bytes'] += traced_bytes
+
+    if len(_events) < _max_events:
+        event = dict(name = name, ph = 'X', ts = start*1e6, dur = duration*1e6, pid = os.getpid(),
+                     tid = threading.get_ident() % 2**31)
+        if args:
+            event['args'] = args
+        _events.append(event)
+
+
+def instrument(func):
+    '''
+    Decorator recording the calls of func (as '<module>.<qualname>') while profiling is enabled
+    '''
+    name = func.__module__ + '.' + func.__qualname__
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if not _enabled:
+            return func(*args, **kwargs)
+        in_bytes = _array_bytes(args) + _array_bytes(kwargs.values())
+        traced = tracemalloc.get_traced_memory()[0] if _memory else 0
+        start = time.perf_counter()
+        try:
+            result = func(*args, **kwargs)
+        finally:
+            duration = time.perf_counter() - start
+            traced = tracemalloc.get_traced_memory()[0] - traced if _memory else 0
+        out_bytes = _array_bytes([result])
+        _record(name, start, duration, in_bytes, out_bytes, traced, dict(in_bytes = in_bytes, out_bytes = out_bytes))
+        return result
+    return wrapper
+
+
+@contextlib.contextmanager
+def region(name, **args):
+    '''
+    Context manager recording the enclosed block like an instrumented call; args (e.g. the cell parameters) are
+    attached to its trace event.
+    '''
+    if not _enabled:
+        yield
+        return
+    traced = tracemalloc.get_traced_memory()[0] if _memory else 0
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        duration = time.perf_counter() - start
+        traced = tracemalloc.get_traced_memory()[0] - traced if _memory else 0
+        _record(name, start, duration, 0, 0, traced, {key: repr(value) for key, value in args.items()})
+
+
+def take():
+    '''
+    Records and events collected so far (for merge), clearing them
+    '''
+    collected = (dict(_records), list(_events))
+    reset()
+    return collected
+
+
+def merge(collected):
+    '''
+    Add records and events from take() (e.g. returned by a worker process)
+    '''
+    records, events = collected
+    for name, other in records.items():
+        record = _records.setdefault(name, dict(calls = 0, total_sec = 0., max_sec = 0., in_bytes = 0, out_bytes = 0, traced_bytes = 0))
+        for key in ['calls', 'total_sec', 'in_bytes', 'out_bytes', 'traced_bytes']:
+            record[key] += other[key]
+        record['max_sec'] = max(record['max_sec'], other['max_sec'])
+    _events.extend(events[:max(_max_events - len(_events), 0)])
+
+
+##########---------------------------Reports-------------------------------##############
+
+def stats():
+    '''
+    {name: dict(calls, total_sec, mean_sec, max_sec, in_bytes, out_bytes, traced_bytes)} of everything recorded
+    '''
+    result = dict()
+    for name, record in _records.items():
+        result[name] = dict(record, mean_sec = record['total_sec']/record['calls'])
+    return result
+
+
+def table(sort = 'total_sec'):
+    '''
+    stats() as a list of rows (dicts with a 'name' key), largest sort column first
+    '''
+    rows = [dict(name = name, **record) for name, record in stats().items()]
+    return sorted(rows, key=lambda row: row[sort], reverse=True)
+
+
+def format_table(sort = 'total_sec'):
+    lines = ['%-48s %8s %11s %11s %11s %11s %11s' % ('stage', 'calls', 'total s', 'mean s', 'max s', 'in MB', 'out MB')]
+    for row in table(sort):
+        lines.append('%-48s %8d %11.4f %11.6f %11.6f %11.2f %11.2f' % (row['name'], row['calls'], row['total_sec'],
+                     row['mean_sec'], row['max_sec'], row['in_bytes']/2**20, row['out_bytes']/2**20))
+    return '\n'.join(lines)
+
+
+def write_table(path, sort = 'total_sec'):
+    '''
+    Save table() as CSV
+    '''
+    columns = ['name', 'calls', 'total_sec', 'mean_sec', 'max_sec', 'in_bytes', 'out_bytes', 'traced_bytes']
+    with open(path, 'w', newline='') as f:
+        writer = csv.DictWriter(f, columns)
+        writer.writeheader()
+        writer.writerows(table(sort))
+
+
+def write_trace(path):
+    '''
+    Save the recorded calls in the Chrome trace event format
+    '''
+    with open(path, 'w') as f:
+        json.dump(dict(traceEvents = _events, displayTimeUnit = 'ms'), f)
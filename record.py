@@ -0,0 +1,120 @@
+'''
+Compact container for the data passed between util and analysis, as an alternative to a plain dict.
+'''
+
+import numpy as np
+
+
+class Recording:
+    '''
+    Slotted record with the same keys as the dicts returned by util.decompose_ACDC, util.getSpO2 and
+    util.synthesize_SpO2, usable wherever those dicts are (h['red_AC'], h['spo2'] = ..., 'key' in h, h.keys(), dict(h)).
+
+    - every numpy array stored is cast to dtype (e.g. np.float32 to halve the memory; float64 by default)
+    - time_min is computed on access from the number of samples and sampling_rate instead of being stored
+    - red and IR, when not stored (synthetic data), are computed on access as red_AC + red_DC and IR_AC + IR_DC
+
+    Keys outside the standard ones are kept in a small dict so code adding its own fields keeps working.
+    '''
+    __slots__ = ('dtype', 'red', 'IR', 'red_AC', 'red_DC', 'IR_AC', 'IR_DC', 'ratio', 'spo2',
+                 'sampling_rate', 'tile_range', 'drop_idx', '_extra')
+
+    _fields = ('red', 'IR', 'red_AC', 'red_DC', 'IR_AC', 'IR_DC', 'ratio', 'spo2',
+               'sampling_rate', 'tile_range', 'drop_idx')
+    _sums = {'red': ('red_AC', 'red_DC'), 'IR': ('IR_AC', 'IR_DC')}
+
+    def __init__(self, dtype = np.float64, **fields):
+        self.dtype = np.dtype(dtype)
+        for key in self._fields:
+            setattr(self, key, None)
+        self._extra = dict()
+        for key, value in fields.items():
+            self[key] = value
+
+    def _num_samples(self):
+        for key in ['red_AC', 'red', 'IR_AC', 'IR']:
+            value = getattr(self, key)
+            if value is not None:
+                return len(value)
+        raise KeyError('time_min')
+
+    def _stored(self, key):
+        if key in self._fields:
+            return getattr(self, key) is not None
+        return key in self._extra
+
+    def __getitem__(self, key):
+        if key == 'time_min':
+            N = self._num_samples()
+            return np.linspace(0,N/self.sampling_rate,N)/60
+        if key in self._sums and getattr(self, key) is None:
+            AC, DC = self._sums[key]
+            if getattr(self, AC) is not None and getattr(self, DC) is not None:
+                return getattr(self, AC) + getattr(self, DC)
+        if not self._stored(key):
+            raise KeyError(key)
+        if key in self._fields:
+            return getattr(self, key)
+        return self._extra[key]
+
+    def __setitem__(self, key, value):
+        if key == 'time_min':
+            return # always derived
+        if isinstance(value, np.ndarray) and value.dtype.kind == 'f' and value.dtype != self.dtype:
+            value = value.astype(self.dtype)
+        if key in self._fields:
+            setattr(self, key, value)
+        else:
+            self._extra[key] = value
+
+    def __delitem__(self, key):
+        if not self._stored(key):
+            raise KeyError(key)
+        if key in self._fields:
+            setattr(self, key, None)
+        else:
+            del self._extra[key]
+
+    def __contains__(self, key):
+        if key == 'time_min':
+            return any(getattr(self, k) is not None for k in ['red_AC', 'red', 'IR_AC', 'IR'])
+        if key in self._sums and not self._stored(key):
+            return all(self._stored(k) for k in self._sums[key])
+        return self._stored(key)
+
+    def keys(self):
+        keys = [key for key in self._fields if self._stored(key)] + list(self._extra)
+        for key in self._sums:
+            if key not in keys and key in self:
+                keys.append(key)
+        if 'time_min' in self:
+            keys.append('time_min')
+        return keys
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def items(self):
+        return [(key, self[key]) for key in self.keys()]
+
+    def values(self):
+        return [self[key] for key in self.keys()]
+
+    def get(self, key, default = None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def nbytes(self):
+        '''
+        Memory held by the stored arrays
+        '''
+        stored = [getattr(self, key) for key in self._fields] + list(self._extra.values())
+        return sum(value.nbytes for value in stored if isinstance(value, np.ndarray))
+
+    def __repr__(self):
+        return 'Recording(dtype=%s, keys=%s)' % (self.dtype, self.keys())
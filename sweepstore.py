@@ -0,0 +1,102 @@
+'''
+Persistent results of the analysis sweeps (samplingFq_vs_HR, samplingDur_vs_HR, inter_sample_vs_alarm_time).
+
+Every grid cell is saved as soon as it is computed, keyed by the sweep, a fingerprint of its input data, the cell's
+grid coordinates and parameters, and the seed. Running a sweep again with the same store only computes the cells that
+are missing, so an interrupted sweep resumes where it stopped and an extended grid (new rates, durations or
+thresholds) reuses the cells it already has. The assembled result arrays of the last run of each sweep are kept too,
+with their axes, for plotting.plot_stored.
+
+    store = sweepstore.SweepStore('sweeps')
+    analysis.inter_sample_vs_alarm_time(data_synth, None, 5, inter_sample_sec, spo2_thresh, store = store)
+    plotting.plot_stored(store, 'inter_sample_vs_alarm_time')
+
+In a stored sweep every cell draws its random numbers from a seed derived from its key (see parallel.run_cells), so
+its result does not depend on which other cells are in the grid or computed in the same run.
+'''
+
+import os
+import json
+import pickle
+import numpy as np
+from memo import hash_key, _Unhashable
+from loader import write_atomic
+
+
+class SweepStore:
+    '''
+    Directory of sweep cell results (cells/<key>.pkl) and assembled grids (grids/<name>.npz + .json)
+    '''
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(os.path.join(path, 'cells'), exist_ok=True)
+        os.makedirs(os.path.join(path, 'grids'), exist_ok=True)
+
+    def _cell_path(self, key):
+        return os.path.join(self.path, 'cells', key + '.pkl')
+
+    def fingerprint(self, data):
+        '''
+        Content hash of the input data of a sweep (a dict of arrays, values and lazy util.TiledSignal, e.g. data_synth)
+        '''
+        try:
+            return hash_key(dict(data))
+        except _Unhashable as e:
+            raise ValueError('cannot fingerprint the sweep data for the store: %s is not an array, value or object '
+                             'with a content_key()' % e)
+
+    def cell_key(self, cell_func, cell, seed = None):
+        '''
+        Key of one cell: the cell function, the cell description (coordinates, parameters and input fingerprint) and the seed
+        '''
+        return hash_key(cell_func.__module__ + '.' + cell_func.__qualname__, cell, seed)
+
+    def get(self, key):
+        '''
+        The stored result of a cell, or None
+        '''
+        path = self._cell_path(key)
+        if not os.path.exists(path):
+            return None
+        try:
+            with open(path, 'rb') as f:
+                return pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return None
+
+    def put(self, key, result):
+        write_atomic(self._cell_path(key), lambda f: pickle.dump(result, f, protocol=pickle.HIGHEST_PROTOCOL))
+
+    def num_cells(self):
+        return sum(name.endswith('.pkl') for name in os.listdir(os.path.join(self.path, 'cells')))
+
+    def save_grid(self, name, axes, results):
+        '''
+        Save the assembled results (dict of arrays) of sweep name with its axes (dict of 1-D arrays)
+        '''
+        base = os.path.join(self.path, 'grids', name)
+        arrays = {'axis_' + key: np.asarray(value) for key, value in axes.items()}
+        arrays.update({'result_' + key: np.asarray(value) for key, value in results.items()})
+        write_atomic(base + '.npz', lambda f: np.savez(f, **arrays))
+        meta = dict(axes = list(axes), results = list(results))
+        write_atomic(base + '.json', lambda f: f.write(json.dumps(meta).encode()))
+
+    def load_grid(self, name):
+        '''
+        axes, results (dicts of arrays) last saved for sweep name
+        '''
+        base = os.path.join(self.path, 'grids', name)
+        with open(base + '.json') as f:
+            meta = json.load(f)
+        with np.load(base + '.npz') as arrays:
+            axes = {key: arrays['axis_' + key] for key in meta['axes']}
+            results = {key: arrays['result_' + key] for key in meta['results']}
+        return axes, results
+
+    def grids(self):
+        return sorted(name[:-5] for name in os.listdir(os.path.join(self.path, 'grids')) if name.endswith('.json'))
+
+    def clear(self):
+        for folder in ['cells', 'grids']:
+            for name in os.listdir(os.path.join(self.path, folder)):
+                os.remove(os.path.join(self.path, folder, name))
@@ -0,0 +1,21 @@
+import os
+import sys
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture
+def recording():
+    '''
+    Two minutes of a clean synthetic PPG at 25 Hz (72 bpm), decomposed as a real recording would be
+    '''
+    import util
+    sampling_rate = 25
+    t = np.arange(120*sampling_rate)/sampling_rate
+    red = 1000 + 20*np.sin(2*np.pi*1.2*t)
+    IR = 1500 + 30*np.sin(2*np.pi*1.2*t)
+    h = util.decompose_ACDC(red, IR, sampling_rate)
+    h['tile_range'] = [10*sampling_rate, 110*sampling_rate]
+    return h
@@ -0,0 +1,51 @@
+import numpy as np
+import util
+
+
+def _windows(num_windows, dur_sec, sampling_rate, noise = .1, seed = 0):
+    # noisy pulses at 50-150 bpm
+    rng = np.random.default_rng(seed)
+    t = np.arange(int(dur_sec*sampling_rate))/sampling_rate
+    for _ in range(num_windows):
+        hr = rng.uniform(50, 150)/60
+        yield np.sin(2*np.pi*hr*t + rng.uniform(0, 2*np.pi)) + noise*rng.standard_normal(len(t))
+
+
+def test_quantile_detect_matches_percentile():
+    # same threshold, and no local maxima closer than the minimum distance at this noise level
+    sampling_rate = 25
+    for dur_sec in [2, 5, 30]:
+        for x in _windows(20, dur_sec, sampling_rate):
+            expected = util.get_HR(x, sampling_rate)[0]
+            np.testing.assert_equal(util.get_HR(x, sampling_rate, 'quantile')[0], expected)
+
+
+def test_detector_chunking():
+    sampling_rate = 25
+    x = np.concatenate(list(_windows(10, 60, sampling_rate, noise = .3)))
+    detector = util.PeakDetector(sampling_rate, 'quantile', warmup_sec = 2)
+    expected = detector.update(x) + detector.flush()
+    for chunk in [1, 7, 1000]:
+        detector = util.PeakDetector(sampling_rate, 'quantile', warmup_sec = 2)
+        peaks = []
+        for start in range(0, len(x), chunk):
+            peaks += detector.update(x[start:start + chunk])
+        assert peaks + detector.flush() == expected
+
+
+def test_peak_index_matches_get_HR():
+    # quantized signals have plateaus and peaks of equal height
+    sampling_rate = 25
+    rng = np.random.default_rng(1)
+    for levels in [None, 3, 8]:
+        for x in _windows(10, 120, sampling_rate, noise = .3, seed = levels or 0):
+            if levels is not None:
+                x = np.round(x*levels)/levels
+            peaks = util.PeakIndex(x, sampling_rate)
+            length = int(rng.uniform(2, 30)*sampling_rate)
+            starts = rng.integers(0, len(x) - length, 60)
+            expected = [util.get_HR(x[start:start + length], sampling_rate)[0] for start in starts]
+            np.testing.assert_equal(peaks.get_HR_windows(starts, length), expected)
+            offsets = rng.integers(0, len(x) - 100, 20)
+            expected = [util.get_HR(x[offset:], sampling_rate)[0] for offset in offsets]
+            np.testing.assert_equal(peaks.get_HR_offsets(offsets), expected)
@@ -0,0 +1,34 @@
+import numpy as np
+import pytest
+import util
+import analysis
+import sweepstore
+
+
+PARAMS = dict(baseline_spo2 = 97, drop_time_sec = 60, recover_time_sec = 60, drop_frac = 0.85, noise = 1)
+
+
+def test_stored_sweep_on_lazy_data(recording, tmp_path):
+    data_synth = util.synthesize_SpO2_lazy(recording, PARAMS, seed = 1)
+    store = sweepstore.SweepStore(str(tmp_path))
+    inter, thresh = np.array([0, 30]), np.array([95, 92])
+
+    first = analysis.inter_sample_vs_alarm_time(data_synth, None, 5, inter, thresh, seed = 0, store = store)
+    assert store.num_cells() == len(inter)*len(thresh)
+
+    # the same lazy data, built again, is recognized and nothing is recomputed
+    again = util.synthesize_SpO2_lazy(recording, PARAMS, seed = 1)
+    assert store.fingerprint(again) == store.fingerprint(data_synth)
+    second = analysis.inter_sample_vs_alarm_time(again, None, 5, inter, thresh, seed = 0, store = store)
+    assert store.num_cells() == len(inter)*len(thresh)
+    np.testing.assert_array_equal(first[0], second[0])
+
+    # other lazy data is not
+    other = util.synthesize_SpO2_lazy(recording, PARAMS, seed = 2)
+    assert store.fingerprint(other) != store.fingerprint(data_synth)
+
+
+def test_fingerprint_of_unhashable_data(tmp_path):
+    store = sweepstore.SweepStore(str(tmp_path))
+    with pytest.raises(ValueError):
+        store.fingerprint(dict(values = object()))
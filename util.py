@@ -1,14 +1,15 @@
+import bisect
+import collections
 import numpy as np
-import pandas as pd
-from scipy import signal, interpolate
+from scipy import signal
+from record import Recording
+from memo import memoize
+from profiling import instrument
 
 
 
 
-def decompose_ACDC(red, infrared, sampling_rate):
-    
-    N = len(red)
-    
+def _design_ACDC_filters(sampling_rate):
     #  create high/low pass filters
     high_cut = 20  # anything lower than 20 Hz is not heart rate
     low_cut = 2
@@ -17,16 +18,89 @@ def decompose_ACDC(red, infrared, sampling_rate):
 
     high_pass = signal.butter(1, high_cut/nyq, 'highpass', fs=sampling_rate, output='sos')
     low_pass  = signal.butter(2, low_cut/nyq, 'lowpass',  fs=sampling_rate, output='sos')
-    
+    return high_pass, low_pass
+
+
+class FilterBank:
+    '''
+    The filters used at one sampling rate, designed once (see filter_bank): high_pass/low_pass split AC and DC
+    (decompose_ACDC), noise_low_pass shapes the synthetic noise (synthesize_SpO2). Filtering runs along the last axis
+    of arrays of any shape, e.g. (recordings x channels x samples), in one sosfilt call per filter.
+    '''
+    def __init__(self, sampling_rate):
+        self.sampling_rate = sampling_rate
+        self.high_pass, self.low_pass = _design_ACDC_filters(sampling_rate)
+        self.noise_low_pass = signal.butter(2, .01, 'lowpass',  fs=sampling_rate, output='sos')
+
+    def decompose(self, x, lengths = None):
+        '''
+        AC and DC components of every row of x (samples along the last axis), as decompose_ACDC computes them.
+        lengths (broadcastable to x.shape[:-1]): number of valid samples per row for rows padded at the end; the mean
+        is taken over the valid samples and the padding is NaN in the output. The filters are causal, so the padding
+        does not affect the valid samples.
+        '''
+        x = np.asarray(x, dtype=float)
+        if lengths is None:
+            mean = np.mean(x, axis=-1, keepdims=True)
+        else:
+            lengths = np.broadcast_to(lengths, x.shape[:-1])
+            valid = np.arange(x.shape[-1]) < lengths[...,None]
+            x = np.where(valid, x, 0)
+            mean = (np.sum(x, axis=-1)/np.maximum(lengths, 1))[...,None]
+
+        AC = signal.sosfilt(self.high_pass, x-mean, axis=-1)
+        DC = signal.sosfilt(self.low_pass, x-mean, axis=-1) + mean
+        if lengths is not None:
+            AC[~valid] = float('nan')
+            DC[~valid] = float('nan')
+        return AC, DC
+
+    def noise(self, white, noise_level = 1):
+        '''
+        white noise (samples along the last axis) low-passed with noise_low_pass and scaled by noise_level
+        '''
+        return signal.sosfilt(self.noise_low_pass, white, axis=-1) * noise_level
 
-    # extract AC & DC components
-    red_AC = signal.sosfilt(high_pass, red-np.mean(red))
-    red_DC = signal.sosfilt(low_pass, red-np.mean(red))+ np.mean(red)
 
-    IR_AC = signal.sosfilt(high_pass, infrared-np.mean(infrared))
-    IR_DC = signal.sosfilt(low_pass, infrared-np.mean(infrared)) + np.mean(infrared)
+_filter_banks = dict()
+
+
+def filter_bank(sampling_rate):
+    '''
+    The FilterBank for sampling_rate, designed on the first call and reused afterwards
+    '''
+    bank = _filter_banks.get(sampling_rate)
+    if bank is None:
+        bank = _filter_banks[sampling_rate] = FilterBank(sampling_rate)
+    return bank
+
+
+@instrument
+@memoize
+def _ACDC_components(red, infrared, sampling_rate):
+    bank = filter_bank(sampling_rate)
+    if np.shape(red) != np.shape(infrared):
+        # channels of different lengths are filtered one at a time
+        (red_AC,), (red_DC,) = bank.decompose(np.asarray(red)[None])
+        (IR_AC,), (IR_DC,) = bank.decompose(np.asarray(infrared)[None])
+        return red_AC, red_DC, IR_AC, IR_DC
+
+    # extract AC & DC components of both channels at once
+    AC, DC = bank.decompose(np.stack([red, infrared]))
+    return AC[0], DC[0], AC[1], DC[1]
+
+
+@instrument
+def decompose_ACDC(red, infrared, sampling_rate, dtype = None):
+    '''
+    dtype: if given (e.g. np.float32), return a record.Recording storing arrays with that dtype instead of a dict
+    '''
     
-    data = dict()
+    N = len(red)
+    
+    red_AC, red_DC, IR_AC, IR_DC = _ACDC_components(red, infrared, sampling_rate)
+    
+    data = dict() if dtype is None else Recording(dtype)
     data['red'] = red
     data['IR'] = infrared
     data['red_AC'] = red_AC
@@ -34,48 +108,341 @@ def decompose_ACDC(red, infrared, sampling_rate):
     data['IR_AC'] = IR_AC
     data['IR_DC'] = IR_DC
     data['sampling_rate'] = sampling_rate
-    data['time_min'] = np.linspace(0,N/data['sampling_rate'],N)/60
+    if dtype is None:
+        data['time_min'] = np.linspace(0,N/data['sampling_rate'],N)/60 # computed on access by Recording
     
     return data
 
 
-def getSpO2(h, tile_range, sec_to_avg = 3):
-    red_AC = h['red_AC']
-    red_DC = h['red_DC']
-    
-    IR_AC = h['IR_AC']
-    IR_DC = h['IR_DC']
-    
-    sampling_rate = h['sampling_rate']
-    
+def stack_rows(arrays, fill = 0.):
+    '''
+    1-D arrays of different lengths as one (len(arrays) x longest) array padded with fill at the end, and their lengths
+    '''
+    lengths = np.array([len(x) for x in arrays], dtype=int)
+    stacked = np.full((len(arrays), max(lengths, default=0)), fill, dtype=float)
+    for row, x in zip(stacked, arrays):
+        row[:len(x)] = x
+    return stacked, lengths
+
+
+@instrument
+def decompose_ACDC_batch(red, infrared, sampling_rate, lengths = None):
+    '''
+    decompose_ACDC of many recordings with the same sampling rate in one filtering pass. red and infrared are
+    (recordings x samples) arrays, with lengths giving the valid samples of each row, or lists of 1-D arrays (stacked
+    with stack_rows). Returns a dict of (recordings x samples) arrays, NaN past each row's length, plus 'lengths';
+    row i matches decompose_ACDC(red[i][:lengths[i]], infrared[i][:lengths[i]], sampling_rate).
+    '''
+    if isinstance(red, (list, tuple)):
+        red, lengths = stack_rows(red)
+        infrared, _ = stack_rows(infrared)
+    red, infrared = np.asarray(red, dtype=float), np.asarray(infrared, dtype=float)
+    N = red.shape[-1]
+    if lengths is None:
+        lengths = np.full(red.shape[:-1], N, dtype=int)
+
+    # (recordings x channels x samples)
+    AC, DC = filter_bank(sampling_rate).decompose(np.stack([red, infrared], axis=-2), np.asarray(lengths)[...,None])
+
+    data = dict()
+    data['red'] = red
+    data['IR'] = infrared
+    data['red_AC'] = AC[...,0,:]
+    data['red_DC'] = DC[...,0,:]
+    data['IR_AC'] = AC[...,1,:]
+    data['IR_DC'] = DC[...,1,:]
+    data['sampling_rate'] = sampling_rate
+    data['lengths'] = np.asarray(lengths)
+    data['time_min'] = np.arange(N)/sampling_rate/60
+    return data
+
+
+class StreamingACDC:
+    '''
+    Chunked version of decompose_ACDC: feed red/infrared samples in any chunk size with update() and get back the same
+    dict of AC/DC components for that chunk. The filter states (zi) and the DC offset are carried between calls, so memory
+    does not grow with the length of the recording.
+
+    decompose_ACDC subtracts the mean of the whole recording before filtering; here the offset is the mean of the first
+    chunk and stays fixed (it is not a running estimate: changing it would be a step input to the filters). If the
+    whole recording is passed as one chunk the output is identical to decompose_ACDC. Otherwise the outputs differ by
+    the filters' response to (global mean - first chunk mean), which decays away during a warm-up of a few seconds
+    (about 6.5 s for DC and 0.5 s for AC to fall below 1% of the initial error at 25 Hz). So the output depends on the
+    size of the first chunk, though not on how the later samples are chunked: on recordings not much longer than the
+    warm-up, pass the first few seconds as one chunk.
+    time_min is computed from the running sample count rather than from a linspace over the whole recording.
+    '''
+    def __init__(self, sampling_rate):
+        self.sampling_rate = sampling_rate
+        bank = filter_bank(sampling_rate)
+        self.high_pass, self.low_pass = bank.high_pass, bank.low_pass
+        self.reset()
+
+    def reset(self):
+        self.n_samples = 0
+        self.offset = dict() # per channel: the mean of the first chunk
+        self.zi = dict()
+        for channel in ['red', 'IR']:
+            self.zi[channel + '_AC'] = np.zeros((self.high_pass.shape[0], 2))
+            self.zi[channel + '_DC'] = np.zeros((self.low_pass.shape[0], 2))
+
+    def _filter(self, channel, x):
+        x = np.asarray(x, dtype=float)
+        if channel not in self.offset:
+            self.offset[channel] = np.mean(x)
+        x = x - self.offset[channel]
+        AC, self.zi[channel + '_AC'] = signal.sosfilt(self.high_pass, x, zi=self.zi[channel + '_AC'])
+        DC, self.zi[channel + '_DC'] = signal.sosfilt(self.low_pass, x, zi=self.zi[channel + '_DC'])
+        return AC, DC + self.offset[channel]
+
+    def update(self, red, infrared):
+        N = len(red)
+        red_AC, red_DC = self._filter('red', red)
+        IR_AC, IR_DC = self._filter('IR', infrared)
+
+        data = dict()
+        data['red'] = red
+        data['IR'] = infrared
+        data['red_AC'] = red_AC
+        data['red_DC'] = red_DC
+        data['IR_AC'] = IR_AC
+        data['IR_DC'] = IR_DC
+        data['sampling_rate'] = self.sampling_rate
+        data['time_min'] = (self.n_samples + np.arange(N))/self.sampling_rate/60
+
+        self.n_samples += N
+        return data
+
+
+def _strided_windows(x, length):
+    # (len(x)-length+1, length) view of x, row i is x[i:i+length]
+    stride = x.strides[0]
+    num_windows = len(x) - length + 1
+    return np.lib.stride_tricks.as_strided(x, shape=(num_windows, length), strides=(stride, stride), writeable=False)
+
+
+@instrument
+def _get_ratio(h, idx = None):
+    # idx: only at these sample indices (any shape), which also works for TiledSignal components
+    if idx is None:
+        red_AC, red_DC, IR_AC, IR_DC = [np.asarray(h[key]) for key in ['red_AC', 'red_DC', 'IR_AC', 'IR_DC']]
+    else:
+        red_AC, red_DC, IR_AC, IR_DC = [h[key][idx] for key in ['red_AC', 'red_DC', 'IR_AC', 'IR_DC']]
+
     #  calculate R
     R = (red_AC/red_DC)/(IR_AC/IR_DC)
 
     # clean data
     R[R>2] = float('nan')
     R[R<0] = float('nan')
-    R_avg = pd.Series(R).rolling(int(sampling_rate*sec_to_avg), min_periods=2).mean()
+    return R
+
+
+def _rolling_sums_mean(values, counts, window, min_periods):
+    # trailing sum(values)/sum(counts) over the last window entries along the last axis, NaN where the count is below
+    # min_periods, from cumulative sums
+    zeros = np.zeros(values.shape[:-1] + (1,))
+    # float64 sums whatever the input dtype (float32 Recording), as pandas accumulates
+    cum_values = np.concatenate([zeros, np.cumsum(values, axis=-1, dtype=np.float64)], axis=-1)
+    cum_counts = np.concatenate([zeros, np.cumsum(counts, axis=-1, dtype=np.float64)], axis=-1)
+
+    end = np.arange(1, values.shape[-1]+1)
+    begin = np.maximum(end-window, 0)
+    num_valid = cum_counts[...,end] - cum_counts[...,begin]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        avg = (cum_values[...,end] - cum_values[...,begin])/num_valid
+    avg[num_valid < min_periods] = float('nan')
+    return avg
+
+
+@instrument
+def _rolling_nanmean(x, window, min_periods = 2):
+    # trailing mean over the last window samples along the last axis, ignoring NaNs, NaN where fewer than min_periods
+    # are valid (pd.Series(x).rolling(window, min_periods).mean()), from cumulative sums of the values and valid counts
+    valid = ~np.isnan(x)
+    return _rolling_sums_mean(np.where(valid, x, 0), valid, window, min_periods)
+
+
+@memoize
+def _ratio_spo2(red_AC, red_DC, IR_AC, IR_DC, sampling_rate, sec_to_avg):
+    R = _get_ratio(dict(red_AC = red_AC, red_DC = red_DC, IR_AC = IR_AC, IR_DC = IR_DC))
+    # 2-D R: one realization per row (synthesize_SpO2_batch)
+    R_avg = _rolling_nanmean(R, int(sampling_rate*sec_to_avg))
     
     #  Spo2 conversion
     Spo2 = 120-(40*R_avg)
-    
-    h['ratio'] = np.array(R)
-    h['spo2'] = np.array(Spo2)
+    return np.array(R), np.array(Spo2)
+
+
+@instrument
+def getSpO2(h, tile_range, sec_to_avg = 3):
+    h['ratio'], h['spo2'] = _ratio_spo2(h['red_AC'], h['red_DC'], h['IR_AC'], h['IR_DC'], h['sampling_rate'], sec_to_avg)
     h['tile_range'] = tile_range # the indices for which the data are more-or-less continuous when looped
     return h
 
+
+def _decimation_factor(avg_len, sampling_rate, max_rate = 4):
+    # smallest divisor of avg_len bringing the rate down to max_rate Hz, so that the decimated rolling average is exact
+    divisors = [d for d in range(1, avg_len+1) if avg_len % d == 0 and sampling_rate/d <= max_rate]
+    return min(divisors) if divisors else 1
+
+
+@instrument
+def getSpO2_decimated(h, factor = None, sec_to_avg = 3, block_size = 2**20):
+    '''
+    SpO2 trend of h at sampling_rate/factor: the ratio is computed at full rate one block at a time and only its sums
+    over groups of factor samples are kept, so memory is O(N/factor) for lazy (TiledSignal) data. spo2[k] is the
+    getSpO2 value at sample sample_idx[k] (the last of group k); it is exact when factor divides the averaging window
+    (the default factor: the smallest one that does and brings the rate to 4 Hz or less, see _decimation_factor),
+    except for a last, partial group. Otherwise the window is rounded to whole groups.
+    ratio is the group mean of the ratio, red_DC/IR_DC are taken at sample_idx, red_AC/IR_AC are kept at full rate
+    for get_HR. Use decimation_error to compare with the full-rate path.
+    '''
+    sampling_rate = h['sampling_rate']
+    avg_len = int(sampling_rate*sec_to_avg)
+    if factor is None:
+        factor = _decimation_factor(avg_len, sampling_rate)
+    N = len(h['red_AC'])
+    num_groups = -(-N//factor)
+    block_size = max(factor, block_size//factor*factor)
+
+    sums = np.zeros(num_groups)
+    counts = np.zeros(num_groups)
+    for b in range(0, N, block_size):
+        R = _get_ratio(h, slice(b, min(b+block_size, N)))
+        # NaN-pad the last block to whole groups
+        R = np.concatenate([R, np.full(-len(R) % factor, float('nan'))]).reshape(-1, factor)
+        valid = ~np.isnan(R)
+        groups = slice(b//factor, b//factor + len(R))
+        sums[groups] = np.where(valid, R, 0).sum(axis=1)
+        counts[groups] = valid.sum(axis=1)
+
+    R_avg = _rolling_sums_mean(sums, counts, max(1, int(round(avg_len/factor))), 2)
+    sample_idx = np.minimum((np.arange(num_groups)+1)*factor, N) - 1
+
+    data = dict()
+    with np.errstate(invalid='ignore', divide='ignore'):
+        data['ratio'] = sums/counts
+    #  Spo2 conversion
+    data['spo2'] = 120-(40*R_avg)
+    data['red_DC'] = np.asarray(h['red_DC'][sample_idx])
+    data['IR_DC'] = np.asarray(h['IR_DC'][sample_idx])
+    data['red_AC'] = h['red_AC']
+    data['IR_AC'] = h['IR_AC']
+    data['sample_idx'] = sample_idx
+    data['decimation'] = factor
+    data['sampling_rate'] = sampling_rate/factor
+    data['time_min'] = sample_idx/sampling_rate/60
+    if 'tile_range' in h:
+        data['tile_range'] = h['tile_range']
+    return data
+
+
+def decimation_error(h, decimated, sec_to_avg = 3):
+    '''
+    Error of getSpO2_decimated output against the full-rate getSpO2 SpO2 at the same samples: max, mean and rms
+    absolute difference, and the number of samples that are NaN in only one of them.
+    '''
+    _, spo2 = _ratio_spo2(np.asarray(h['red_AC']), np.asarray(h['red_DC']), np.asarray(h['IR_AC']),
+                          np.asarray(h['IR_DC']), h['sampling_rate'], sec_to_avg)
+    full = spo2[decimated['sample_idx']]
+    diff = np.abs(decimated['spo2'] - full)
+    both = ~np.isnan(diff)
+    nan_mismatch = int(np.sum(np.isnan(full) != np.isnan(decimated['spo2'])))
+    if not np.any(both):
+        return dict(max = float('nan'), mean = float('nan'), rms = float('nan'), nan_mismatch = nan_mismatch)
+    return dict(max = float(np.max(diff[both])), mean = float(np.mean(diff[both])),
+                rms = float(np.sqrt(np.mean(diff[both]**2))), nan_mismatch = nan_mismatch)
+
+
+@instrument
+def getSpO2_windows(h, starts, sample_len, sec_to_avg = 3):
+    '''
+    Average SpO2 in each window [start, start+sample_len) of h, computed as if getSpO2 had been run on the window alone
+    (the rolling average restarts at the window start) followed by np.nanmean, but for all windows at once.
+    Windows running past the end of the data are truncated. starts can have any shape, the output has the same shape.
+    '''
+    sampling_rate = h['sampling_rate']
+    avg_len = int(sampling_rate*sec_to_avg)
+
+    N = len(h['red_AC'])
+    starts = np.asarray(starts, dtype=int)
+    flat_starts = starts.ravel()
+
+    # lazy (TiledSignal) components are only evaluated inside the windows
+    lazy = any(isinstance(h[key], TiledSignal) for key in ['red_AC', 'red_DC', 'IR_AC', 'IR_DC'])
+    if not lazy:
+        # windows past the end read NaN padding
+        R = np.concatenate([_get_ratio(h), np.full(sample_len, float('nan'))])
+
+    spo2 = np.zeros(len(flat_starts))
+    block_size = max(1, 2**22//sample_len) # bound the (windows x samples) arrays
+    for b in range(0, len(flat_starts), block_size):
+        block_starts = flat_starts[b:b+block_size]
+        idx = block_starts[:,None] + np.arange(sample_len)
+        if lazy:
+            block_R = _get_ratio(h, np.minimum(idx, N-1))
+            block_R[idx >= N] = float('nan')
+        else:
+            block_R = _strided_windows(R, sample_len)[block_starts]
+        R_avg = _rolling_nanmean(block_R, avg_len)
+        R_avg[idx >= N] = float('nan')
+
+        #  Spo2 conversion
+        Spo2 = 120-(40*R_avg)
+        spo2[b:b+block_size] = np.nanmean(Spo2, axis=1)
+    return spo2.reshape(starts.shape)
+
+def suggest_tile_range(h, warmup_sec = 2, min_frac = .5):
+    '''
+    Suggest a tile_range [start, end) for which the data are approximately continuous when looped (see synthesize_SpO2):
+    start after the filter warm-up, and end where the IR AC and DC components (value and slope) best match those at start.
+    The segment keeps at least min_frac of the data after start.
+    '''
+    sampling_rate = h['sampling_rate']
+    N = len(h['IR_AC'])
+    start = min(int(warmup_sec*sampling_rate), N//4)
+    ends = np.arange(start + max(int((N-start)*min_frac), 2), N)
+
+    # when looped, x[start] follows x[end-1], so x[end] should look like x[start]
+    cost = np.zeros(len(ends))
+    for key in ['IR_AC', 'IR_DC']:
+        x = np.asarray(h[key], dtype=float)
+        scale = np.std(x[start:]) or 1
+        cost += np.abs(x[ends] - x[start])/scale
+        cost += np.abs((x[ends] - x[ends-1]) - (x[start+1] - x[start]))/scale
+    return [int(start), int(ends[np.argmin(cost)])]
+
 #######--------------------- Calculate heart rate ----------------------#########
 
-def get_HR(hr_signal, sampling_rate):
+def _min_btw_peaks(sampling_rate):
     max_HR = 250 # for calculating the minimum number of samples between peaks
-    mins_in_sample = (len(hr_signal)/sampling_rate)/60
     max_BPS = max_HR/60
-    min_btw_samples = int(np.ceil(sampling_rate/max_BPS))
+    return int(np.ceil(sampling_rate/max_BPS))
+
+
+@instrument
+def get_HR(hr_signal, sampling_rate, detector = 'percentile'):
+    '''
+    detector: 'percentile' (peaks above the 80th percentile of the whole signal), or 'quantile' / 'envelope' for a
+    PeakDetector with that adaptive threshold. 'envelope' is the fastest (about half the time of 'percentile' on 2-10 s
+    windows); 'quantile' uses the same threshold as 'percentile' on signals up to 30 s, and so the same peaks unless two
+    local maxima above it are closer than the minimum distance (PeakDetector keeps the higher of the two as they come,
+    find_peaks the highest ones first), at slightly more cost.
+    Returns NaN (without a warning) if fewer than 2 peaks are found.
+    '''
+    mins_in_sample = (len(hr_signal)/sampling_rate)/60
+    min_btw_samples = _min_btw_peaks(sampling_rate)
     
-    min_height = np.percentile(hr_signal,80)
+    if detector == 'percentile':
+        min_height = np.percentile(hr_signal,80)
 
-    pks = signal.find_peaks(hr_signal, distance = min_btw_samples, height = min_height)
-    pks = pks[0]
+        pks = signal.find_peaks(hr_signal, distance = min_btw_samples, height = min_height)
+        pks = pks[0]
+    else:
+        pks = PeakDetector(sampling_rate, detector).detect(hr_signal)
+    if len(pks) < 2:
+        return float('nan'), pks
     
     # average inter-peak-interval is more reliable than a # peaks/time measure
     ipi = pks[1:] - pks[:-1]
@@ -85,59 +452,488 @@ def get_HR(hr_signal, sampling_rate):
    
 
 
+def _select_by_distance(peaks, heights, distance):
+    # same greedy selection as signal.find_peaks(distance=...): keep the highest peaks, drop lower neighbours
+    keep = np.ones(len(peaks), dtype=bool)
+    for j in np.argsort(heights)[::-1]:
+        if not keep[j]:
+            continue
+        k = j-1
+        while k >= 0 and peaks[j]-peaks[k] < distance:
+            keep[k] = False
+            k -= 1
+        k = j+1
+        while k < len(peaks) and peaks[k]-peaks[j] < distance:
+            keep[k] = False
+            k += 1
+    return peaks[keep]
+
+
+class PeakIndex:
+    '''
+    Find the candidate peaks (local maxima) of hr_signal once, then get the get_HR estimate for many slices of it
+    without calling find_peaks again: start offsets (hr_signal[start_idx:]) with get_HR_offsets and fixed-length windows
+    (hr_signal[start:start+length]) with get_HR_windows. Candidates are kept sorted by index so each slice is a
+    searchsorted range, the 80th percentile height thresholds are computed for all slices in one batch, and the distance
+    criterion is only re-applied for slices where two candidates are closer than min_btw_samples.
+    Candidates on plateaus are their midpoints and equal heights are resolved as in find_peaks, so the results are
+    those of get_HR, also on quantized signals; only a peak exactly at the percentile threshold can fall on the other
+    side of it through floating point rounding.
+    '''
+    @instrument
+    def __init__(self, hr_signal, sampling_rate):
+        self.hr_signal = np.asarray(hr_signal, dtype=float)
+        self.sampling_rate = sampling_rate
+        self.min_btw_samples = _min_btw_peaks(sampling_rate)
+
+        pks, props = signal.find_peaks(self.hr_signal, plateau_size=1)
+        self.peaks = pks
+        # a peak needs both neighbours of its plateau inside the slice
+        self.left_edges = props['left_edges']
+        self.right_edges = props['right_edges']
+        self.heights = self.hr_signal[pks]
+
+    def _suffix_percentiles(self, start_idxs, q=80):
+        # percentile of hr_signal[start_idx:] for every start: rank the samples once, count the ones still in each slice
+        order = np.argsort(self.hr_signal, kind='stable')
+        in_slice = order[None,:] >= start_idxs[:,None]
+        counts = np.cumsum(in_slice, axis=1)
+        n = len(self.hr_signal) - start_idxs
+        rank = (q/100)*(n-1)
+        below = np.floor(rank).astype(int)
+        above = np.minimum(below+1, n-1)
+        sorted_signal = self.hr_signal[order]
+        lo = sorted_signal[np.argmax(counts > below[:,None], axis=1)]
+        hi = sorted_signal[np.argmax(counts > above[:,None], axis=1)]
+        return lo + (hi-lo)*(rank-below)
+
+    def _window_percentiles(self, starts, length, q=80):
+        # percentile of hr_signal[start:start+length] for every start, as np.percentile (linear interpolation), from a
+        # sliding window: its samples are kept sorted and, going through the starts in order, the samples that leave
+        # are removed and those that enter are inserted (bisect), so consecutive starts cost O(length) each and
+        # memory is O(length) instead of (windows x length)
+        x = self.hr_signal.tolist()
+        rank = (q/100)*(length-1)
+        below = int(np.floor(rank))
+        above = min(below+1, length-1)
+        fraction = rank - below
+
+        percentiles = np.zeros(len(starts))
+        window = []
+        previous = None
+        for i in np.argsort(starts, kind='stable'):
+            start = int(starts[i])
+            if previous is None or start - previous >= length:
+                window = sorted(x[start:start+length])
+            else:
+                for k in range(previous, start):
+                    del window[bisect.bisect_left(window, x[k])]
+                    bisect.insort(window, x[k+length])
+            previous = start
+            percentiles[i] = window[below] + (window[above] - window[below])*fraction
+        return percentiles
+
+    @instrument
+    def _get_HR(self, starts, stops, min_height, block_size=1024):
+        hr = np.full(len(starts), float('nan'))
+        for b in range(0, len(starts), block_size):
+            block = slice(b, b+block_size)
+            # only candidates that can be in at least one slice of the block
+            cols = np.flatnonzero((self.heights >= np.min(min_height[block])) &
+                                  (self.left_edges > np.min(starts[block])) &
+                                  (self.right_edges < np.max(stops[block])-1))
+            if len(cols) == 0:
+                continue
+            peaks, heights = self.peaks[cols], self.heights[cols]
+            valid = ((self.left_edges[cols][None,:] > starts[block,None]) &
+                     (self.right_edges[cols][None,:] < stops[block,None]-1) &
+                     (heights[None,:] >= min_height[block,None]))
+            rows = np.arange(len(valid))[:,None]
+
+            # previous valid candidate in each slice; pairs closer than min_btw_samples keep only the higher peak
+            previous = np.maximum.accumulate(np.where(valid, np.arange(len(cols)), -1), axis=1)
+            previous = np.concatenate([np.full((len(valid),1), -1), previous[:,:-1]], axis=1)
+            close = valid & (previous >= 0) & (peaks[None,:] - peaks[np.maximum(previous, 0)] < self.min_btw_samples)
+            higher_previous = heights[np.maximum(previous, 0)] > heights[None,:]
+            removed = close & higher_previous
+            removed[np.broadcast_to(rows, close.shape)[close & ~higher_previous], previous[close & ~higher_previous]] = True
+            kept = valid & ~removed
+
+            num_peaks = kept.sum(axis=1)
+            first = np.argmax(kept, axis=1)
+            last = len(cols) - 1 - np.argmax(kept[:,::-1], axis=1)
+            span = (peaks[last] - peaks[first]).astype(float)
+
+            # runs of three or more close candidates, and close pairs of equal height (find_peaks orders ties by
+            # np.argsort of all the heights), need the full greedy selection of find_peaks
+            chained = np.any(close & close[rows, np.maximum(previous, 0)], axis=1)
+            chained |= np.any(close & (heights[np.maximum(previous, 0)] == heights[None,:]), axis=1)
+            for i in np.flatnonzero(chained):
+                pks = _select_by_distance(peaks[valid[i]], heights[valid[i]], self.min_btw_samples)
+                num_peaks[i] = len(pks)
+                span[i] = pks[-1] - pks[0] if len(pks) else 0
+
+            # mean inter-peak-interval, as in get_HR
+            ok = num_peaks > 1
+            mean_ipi = span[ok]/(num_peaks[ok]-1)
+            hr[block][ok] = (1/mean_ipi) * (self.sampling_rate*60)
+        return hr
+
+    @instrument
+    def get_HR_offsets(self, start_idxs):
+        '''
+        Heart rate of hr_signal[start_idx:] for every start_idx, same as get_HR(hr_signal[start_idx:], sampling_rate)[0]
+        '''
+        start_idxs = np.asarray(start_idxs, dtype=int)
+        stops = np.full(len(start_idxs), len(self.hr_signal))
+        return self._get_HR(start_idxs, stops, self._suffix_percentiles(start_idxs))
+
+    @instrument
+    def get_HR_windows(self, starts, lengths):
+        '''
+        Heart rate of hr_signal[start:start+length] for every (start, length) pair, same as get_HR on each window.
+        lengths can be a single length for all windows.
+        '''
+        starts = np.asarray(starts, dtype=int)
+        lengths = np.broadcast_to(np.asarray(lengths, dtype=int), starts.shape)
+
+        # many random windows repeat once the windows are long, only evaluate each distinct one
+        windows, inverse = np.unique(np.stack([lengths, starts]), axis=1, return_inverse=True)
+        lengths, starts = windows
+        min_height = np.zeros(len(starts))
+        for length in np.unique(lengths):
+            same_length = lengths == length
+            min_height[same_length] = self._window_percentiles(starts[same_length], length)
+        return self._get_HR(starts, starts+lengths, min_height)[inverse.ravel()]
+
+
+#######--------------------- Online estimation ----------------------#########
+
+class PeakDetector:
+    '''
+    Streaming alternative to the peak picking in get_HR, for batch (detect) or incremental (update) use:
+    local maxima above an adaptive threshold, at least _min_btw_peaks apart (the refractory period from max_HR; the
+    higher of two close peaks is kept). A peak is final once that many samples have passed without a higher one, so
+    update reports peaks with a latency of at most 60/max_HR s.
+
+    threshold:
+    - 'quantile': the q-th percentile of the last window_sec of samples (get_HR uses q = 80 of the whole signal), from a
+      ring buffer refreshed every 1/8 window (more often while it fills up, except in detect)
+    - 'envelope': frac times the envelope of the local maxima, decaying by 1/e every decay_sec; no warm-up needed
+
+    No peaks are detected during the first warmup_sec. The output does not depend on how the samples are chunked.
+    '''
+    def __init__(self, sampling_rate, threshold = 'quantile', window_sec = 30, q = 80, decay_sec = 3, frac = .5,
+                 warmup_sec = 0, max_peaks = None):
+        if threshold not in ['quantile', 'envelope']:
+            raise ValueError('threshold should be quantile or envelope, not %s' % threshold)
+        self.threshold_type = threshold
+        self.distance = _min_btw_peaks(sampling_rate)
+        self.window = max(1, int(window_sec*sampling_rate))
+        self.q = q
+        self.log_decay = -1/(decay_sec*sampling_rate)
+        self.frac = frac
+        self.warmup = int(warmup_sec*sampling_rate)
+        self.every = max(1, self.window//8)
+        self.max_peaks = max_peaks
+        self.reset()
+
+    def reset(self):
+        self.buffer = np.zeros(self.window)
+        self.filled = 0
+        self.pos = 0
+        self.envelope = 0.
+        self.next_threshold = max(self.distance, self.warmup) # sample count at which the quantile is next updated
+        self.threshold = float('nan')
+        self.n_samples = 0
+        self.last = np.zeros(0) # the last two samples, whose right neighbours may come with the next chunk
+        self.pending = None # (index, height) of the best candidate not final yet
+        self.peaks = collections.deque(maxlen=self.max_peaks)
+
+    def _append(self, x):
+        m = min(len(x), self.window)
+        self.buffer[(self.pos + len(x) - m + np.arange(m)) % self.window] = x[len(x)-m:]
+        self.pos = (self.pos + len(x)) % self.window
+        self.filled = min(self.filled + len(x), self.window)
+        self.n_samples += len(x)
+
+    def _refresh(self):
+        # while the buffer fills up, update about every 1/8 of what is in it
+        self.threshold = np.percentile(self.buffer[:self.filled], self.q)
+        self.next_threshold = self.n_samples + (self.every if self.filled == self.window else max(self.distance, self.filled//8))
+
+    def _envelope(self, x):
+        # env[i] = max(x[i], env[i-1]*decay), as a running maximum in the log domain (x: the local maxima, else 0)
+        i = np.arange(-1, len(x))
+        log_x = np.log(np.maximum(np.concatenate([[self.envelope], x]), 1e-300))
+        env = np.exp(np.maximum.accumulate(log_x - i*self.log_decay) + i*self.log_decay)
+        self.envelope = env[-1]
+        return env[1:]
+
+    def _candidate(self, idx, height, new):
+        if self.pending is not None and idx - self.pending[0] < self.distance:
+            if height > self.pending[1]:
+                self.pending = (idx, height)
+            return
+        if self.pending is not None:
+            new.append(self.pending[0])
+        self.pending = (idx, height)
+
+    def update(self, x):
+        '''
+        Add samples x; returns the sample indices (counted from the first sample) of the peaks that became final
+        '''
+        x = np.atleast_1d(np.asarray(x, dtype=float))
+        new = []
+        start = 0
+        while start < len(x):
+            # the quantile threshold changes only between pieces, refreshed when the next piece needs it
+            if self.threshold_type == 'quantile':
+                if self.n_samples >= self.next_threshold:
+                    self._refresh()
+                piece = x[start:start + self.next_threshold - self.n_samples]
+            else:
+                piece = x[start:]
+            start += len(piece)
+            ext = np.concatenate([self.last, piece])
+            offset = self.n_samples - len(self.last)
+            if len(ext) >= 3:
+                mid = ext[1:-1]
+                is_peak = (ext[:-2] < mid) & (mid >= ext[2:])
+                if self.threshold_type == 'quantile':
+                    threshold = self.threshold
+                else:
+                    # envelope of the local maxima only, so the filters' start-up transient does not raise it
+                    threshold = self.frac*self._envelope(np.where(is_peak, mid, 0))
+                is_peak &= mid >= threshold
+                is_peak &= offset + np.arange(1, len(ext)-1) >= self.warmup
+                for j in np.flatnonzero(is_peak) + 1:
+                    self._candidate(int(offset + j), ext[j], new)
+            self.last = ext[-2:]
+            self._append(piece)
+
+        if self.pending is not None and self.n_samples - 1 - self.pending[0] >= self.distance:
+            new.append(self.pending[0])
+            self.pending = None
+        self.peaks.extend(new)
+        return new
+
+    def flush(self):
+        '''
+        End of the signal: returns the pending peak (as a list) and makes it final
+        '''
+        new = [] if self.pending is None else [self.pending[0]]
+        self.pending = None
+        self.peaks.extend(new)
+        return new
+
+    def detect(self, x):
+        '''
+        Batch use: peak indices of the whole signal x (after a reset). The quantile threshold of the first window_sec is
+        the percentile of all of it, which update cannot know yet: this skips the refreshes while the buffer fills up
+        and, on signals up to window_sec long, gives get_HR's percentile threshold.
+        '''
+        self.reset()
+        x = np.asarray(x, dtype=float)
+        if self.threshold_type == 'quantile' and len(x):
+            self.threshold = np.percentile(x[:self.window], self.q)
+            self.next_threshold = self.window
+        return np.array(self.update(x) + self.flush(), dtype=int)
+
+
+class OnlineEstimator:
+    '''
+    Real-time SpO2 and HR from red/infrared samples fed one at a time or in chunks, with constant memory and constant
+    cost per sample: filters from StreamingACDC, the rolling ratio average of getSpO2 from running sums over a ring
+    buffer, and the peaks of get_HR from a PeakDetector on -red_AC.
+
+    update() returns, for the samples passed, 'ratio' and 'spo2' (one value per sample) and 'time_min', plus the current
+    'hr' (from the mean inter-peak interval of the last hr_window_sec) and the new 'peaks' (sample indices).
+    SpO2 has no added latency; peaks, and so hr, lag by at most 60/max_HR s (the minimum distance between peaks).
+
+    After the filters' warm-up (see StreamingACDC; 10 s here) spo2 matches getSpO2 on decompose_ACDC of the whole
+    recording within 0.01 (SpO2 %). hr usually equals get_HR over the same last hr_window_sec (on a 40 minute synthetic
+    recording: median difference 0, 95th percentile 0.02 BPM), but can be off by up to ~10 BPM when a peak is close to
+    the threshold, which is the percentile of the recent samples rather than of exactly the window. No peaks are
+    detected during the first 2 s. As StreamingACDC, the results during the warm-up depend on the size of the first
+    chunk (on a 3.5 s proto1 recording, hr is 148 BPM when fed one sample at a time and 74 BPM as one chunk).
+    '''
+    def __init__(self, sampling_rate, sec_to_avg = 3, hr_window_sec = 30):
+        self.sampling_rate = sampling_rate
+        self.avg_len = int(sampling_rate*sec_to_avg)
+        self.hr_window_sec = hr_window_sec
+        self.hr_window = int(sampling_rate*hr_window_sec)
+        self.acdc = StreamingACDC(sampling_rate)
+        self.reset()
+
+    def reset(self):
+        self.acdc.reset()
+        self.n_samples = 0
+        self.values = np.zeros(self.avg_len) # ring buffers of the last avg_len ratios (0 if NaN) and valid flags
+        self.counts = np.zeros(self.avg_len)
+        self.pos = 0
+        self.sum = 0.
+        self.count = 0.
+        self.since_resync = 0
+        # no peaks during the first 2 s: the threshold would come from too few samples and the filters are settling
+        self.peak_tracker = PeakDetector(self.sampling_rate, 'quantile', self.hr_window_sec, warmup_sec = 2,
+                                         max_peaks = self.hr_window//_min_btw_peaks(self.sampling_rate) + 2)
+
+    def _rolling_mean(self, R):
+        # running sums: add the new values, remove those leaving the window (from the ring buffer or from this chunk)
+        n = len(R)
+        valid = ~np.isnan(R)
+        values = np.where(valid, R, 0)
+        counts = valid.astype(float)
+
+        m = min(n, self.avg_len)
+        ring_idx = (self.pos + np.arange(m)) % self.avg_len
+        leaving_values = np.concatenate([self.values[ring_idx], values[:n-m]])
+        leaving_counts = np.concatenate([self.counts[ring_idx], counts[:n-m]])
+
+        sums = self.sum + np.cumsum(values - leaving_values, dtype=np.float64)
+        num_valid = self.count + np.cumsum(counts - leaving_counts, dtype=np.float64)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            avg = sums/num_valid
+        avg[num_valid < 2] = float('nan') # min_periods = 2
+
+        new_idx = (self.pos + np.arange(n-m, n)) % self.avg_len
+        self.values[new_idx] = values[n-m:]
+        self.counts[new_idx] = counts[n-m:]
+        self.pos = (self.pos + n) % self.avg_len
+        self.sum, self.count = sums[-1], num_valid[-1]
+
+        # recompute the sum now and then so rounding errors do not accumulate over hours of data
+        self.since_resync += n
+        if self.since_resync >= 100*self.avg_len:
+            self.sum, self.count = np.sum(self.values), np.sum(self.counts)
+            self.since_resync = 0
+        return avg
+
+    def hr(self):
+        '''
+        HR from the peaks found in the last hr_window_sec (NaN with fewer than 2), including the one not final yet
+        '''
+        peaks = list(self.peak_tracker.peaks)
+        if self.peak_tracker.pending is not None:
+            peaks.append(self.peak_tracker.pending[0])
+        peaks = [p for p in peaks if p >= self.n_samples - self.hr_window]
+        if len(peaks) < 2:
+            return float('nan')
+        mean_ipi = (peaks[-1] - peaks[0])/(len(peaks)-1)
+        return (1/mean_ipi) * (self.sampling_rate*60)
+
+    def update(self, red, infrared):
+        red = np.atleast_1d(np.asarray(red, dtype=float))
+        infrared = np.atleast_1d(np.asarray(infrared, dtype=float))
+        N = len(red)
+        if N == 0:
+            return dict(ratio = np.zeros(0), spo2 = np.zeros(0), time_min = np.zeros(0), hr = self.hr(), peaks = [])
+
+        h = self.acdc.update(red, infrared)
+        R = _get_ratio(h)
+        R_avg = self._rolling_mean(R)
+        peaks = self.peak_tracker.update(-h['red_AC'])
+
+        data = dict()
+        data['ratio'] = R
+        data['spo2'] = 120-(40*R_avg)
+        data['time_min'] = h['time_min']
+        self.n_samples += N
+        data['hr'] = self.hr()
+        data['peaks'] = peaks
+        return data
+
+
 #######---------------------Synthesize data (HR) ----------------------#########
 
-def synth_HR(hr_signal, fq, target_HRs):
+def _resample_rows(hr_signal, lengths, method):
+    # hr_signal stretched to each of lengths (first and last samples kept in place), one NaN-padded row per length
+    hr_signal = np.asarray(hr_signal, dtype=float)
+    N = len(hr_signal)
+    lengths = np.asarray(lengths, dtype=int)
+    rows = np.full((len(lengths), max(lengths.max(initial=0), 1)), float('nan'))
+
+    if method == 'linear':
+        # np.interp on the positions of all rows at once: sample j of a row of length L sits at j*(N-1)/(L-1) in hr_signal
+        j = np.arange(rows.shape[1])
+        step = (N-1)/np.maximum(lengths-1, 1)
+        positions = j*step[:,None]
+        valid = j < lengths[:,None]
+        rows[valid] = np.interp(positions[valid], np.arange(N), hr_signal)
+    elif method == 'polyphase':
+        for i, L in enumerate(lengths):
+            if L < 1:
+                continue
+            g = np.gcd(L, N)
+            resampled = signal.resample_poly(hr_signal, L//g, N//g, padtype='line')
+            rows[i,:L] = resampled[:L]
+    else:
+        raise ValueError('method should be linear or polyphase, not %s' % method)
+    return rows
+
+
+@instrument
+@memoize
+def synth_HR_batch(hr_signal, fq, target_HRs, method = 'linear'):
     '''
-    Synthesize 1 minute of signal at desired heart rate (target_HRs) from empirical data (hr_signal), keeping sampling rate (fq) constant.
+    synth_HR for all target_HRs at once: one row of 1 minute of signal per target HR, as a (len(target_HRs) x samples) array.
+    method: 'linear' (interpolation, as synth_HR) or 'polyphase' (scipy.signal.resample_poly, anti-aliased)
     '''
-    
     N = len(hr_signal)
     samples_per_min = int(np.ceil(fq*60))
     
     HR,_ = get_HR(hr_signal,  fq)
-    t = np.linspace(0, N, N)
-    interpolated = interpolate.interp1d(t, hr_signal, axis = 0, fill_value = 'extrapolate')
-    
-    hr_synth = dict()
-    
-    for target_HR in target_HRs:
-        
-        new_rate = HR/target_HR
-        new_t = np.linspace(0, N, int(N*new_rate))
-        new_hr_signal = interpolated(new_t)
+    lengths = np.array([int(N*HR/target_HR) for target_HR in target_HRs], dtype=int)
+    stretched = _resample_rows(hr_signal, lengths, method)
 
-        num_reps = int(np.ceil(samples_per_min/len(new_hr_signal)))
-        new_hr_signal = np.tile(new_hr_signal, num_reps)
-        
-        new_hr_signal = new_hr_signal[:samples_per_min]
-        hr_synth[target_HR] = new_hr_signal
-    
-    return hr_synth
+    # loop each stretched signal to fill the minute
+    j = np.arange(samples_per_min)
+    idx = j % np.maximum(lengths, 1)[:,None]
+    return np.take_along_axis(stretched, idx, axis=1)
+
+
+def synth_HR(hr_signal, fq, target_HRs, method = 'linear'):
+    '''
+    Synthesize 1 minute of signal at desired heart rate (target_HRs) from empirical data (hr_signal), keeping sampling rate (fq) constant.
+    Returns a dict {target HR: signal}; see synth_HR_batch for the stacked version.
+    '''
+    rows = synth_HR_batch(hr_signal, fq, target_HRs, method)
+    return {target_HR: row for target_HR, row in zip(target_HRs, rows)}
     
     
 # resample HR; maintain duration in seconds
 
-def resample_hr(hr_signal, fq, resampled_fq):
+@instrument
+@memoize
+def resample_hr_batch(hr_signal, fq, resampled_fqs, method = 'linear'):
     '''
-    Synthesize signal at desired sampling rate (resampled_fq) from empirical data (hr_signal), keeping heart rate and sample duration in seconds constant.
+    resample_hr for all resampled_fqs at once. Returns (rows, lengths): row i holds the first lengths[i] samples of the
+    signal at resampled_fqs[i], padded with NaN to the longest. method: 'linear' or 'polyphase' as in synth_HR_batch.
     '''
     N = len(hr_signal)
     seconds_of_data = N/fq
+    lengths = np.array([int(seconds_of_data*resampled_fq) for resampled_fq in resampled_fqs], dtype=int)
+    return _resample_rows(hr_signal, lengths, method), lengths
 
-    t = np.linspace(0, N, N)
-    resampled_t = np.linspace(0, N, int(seconds_of_data*resampled_fq))
-
-    interpolated = interpolate.interp1d(t, hr_signal, axis = 0, fill_value = 'extrapolate')
-    resampled_hr_signal = interpolated(resampled_t)
 
-    return resampled_hr_signal
+def resample_hr(hr_signal, fq, resampled_fq, method = 'linear'):
+    '''
+    Synthesize signal at desired sampling rate (resampled_fq) from empirical data (hr_signal), keeping heart rate and sample duration in seconds constant.
+    '''
+    rows, lengths = resample_hr_batch(hr_signal, fq, [resampled_fq], method)
+    return rows[0,:lengths[0]]
 
 
 #######---------------------Synthesize data (SpO2) ----------------------#########
 
 
-def synthesize_SpO2(h, params):
+@instrument
+def synthesize_SpO2(h, params, dtype = None):
+    '''
+    dtype: if given (e.g. np.float32), return a record.Recording storing arrays with that dtype instead of a dict;
+    red, IR and time_min are then computed on access rather than stored
+    '''
     
     red = h['red']
     IR = h['IR']
@@ -190,26 +986,219 @@ def synthesize_SpO2(h, params):
     
     # add noise
     noise_level = params['noise'] * np.std(IR_DC_synth) * 10
-    low_pass  = signal.butter(2, .01, 'lowpass',  fs=sampling_rate, output='sos')
     noise = np.random.randn(len(IR_DC_synth))
-    noise = signal.sosfilt(low_pass, noise) * noise_level
+    noise = filter_bank(sampling_rate).noise(noise, noise_level)
     IR_DC_synth = IR_DC_synth + noise
     
-    data_synth = dict()
-    data_synth['red'] = red_AC_synth + red_DC_synth
-    data_synth['IR'] = IR_AC_synth + IR_DC_synth
+    if dtype is None:
+        data_synth = dict()
+        data_synth['red'] = red_AC_synth + red_DC_synth
+        data_synth['IR'] = IR_AC_synth + IR_DC_synth
+    else:
+        data_synth = Recording(dtype)
     data_synth['red_AC'] = red_AC_synth
     data_synth['red_DC'] = red_DC_synth
     data_synth['IR_AC'] = IR_AC_synth
     data_synth['IR_DC'] = IR_DC_synth
     data_synth['sampling_rate'] = sampling_rate
     data_synth['drop_idx'] = drop_idx
-    data_synth['time_min'] = np.linspace(0,len(red_AC_synth)/sampling_rate,len(red_AC_synth))/60
+    if dtype is None:
+        data_synth['time_min'] = np.linspace(0,len(red_AC_synth)/sampling_rate,len(red_AC_synth))/60
     
     data_synth = getSpO2(data_synth, tile_range)
 
     return data_synth
 
+class TiledSignal:
+    '''
+    Read-only stand-in for a long synthetic array built by tiling a short base segment, which computes the samples on
+    demand instead of storing them. Sample i is
+
+        base[i % len(base)] * scale * drop_kernel[i - drop_idx] + noise_level * noise[i]
+
+    where the drop kernel only applies within [drop_idx, drop_idx + len(drop_kernel)) and noise is white noise
+    low-passed with low_pass (sos). The noise is drawn in blocks of block_size samples, each from its own generator
+    seeded by (noise_seed, block), and the filter state at the start of every block is stored once, so any slice is
+    reproducible and costs at most one extra block. Without a noise_seed one is drawn at random (and kept). Supports len(), slicing, integer (array) indexing and np.asarray (which builds the full array).
+    '''
+    def __init__(self, base, num_tiles, scale = 1, drop_kernel = None, drop_idx = 0, noise_level = 0, low_pass = None, noise_seed = None, block_size = 4096):
+        self.base = np.asarray(base, dtype=float)
+        self.num_tiles = num_tiles
+        self.scale = scale
+        self.drop_kernel = drop_kernel
+        self.drop_idx = drop_idx
+        self.noise_level = noise_level
+        self.low_pass = low_pass
+        if noise_level and noise_seed is None:
+            noise_seed = np.random.SeedSequence().entropy
+        self.noise_seed = noise_seed
+        self.block_size = block_size
+        self.shape = (len(self.base)*num_tiles,)
+        self.ndim = 1
+        self.dtype = self.base.dtype
+
+        if noise_level:
+            num_blocks = int(np.ceil(len(self)/block_size))
+            self.zi = np.zeros((num_blocks, low_pass.shape[0], 2))
+            zi = np.zeros((low_pass.shape[0], 2))
+            for block in range(num_blocks):
+                self.zi[block] = zi
+                _, zi = signal.sosfilt(low_pass, self._raw_noise(block), zi=zi)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def _raw_noise(self, block):
+        rng = np.random.default_rng([self.noise_seed, block])
+        return rng.standard_normal(min(self.block_size, len(self) - block*self.block_size))
+
+    def _noise_block(self, block):
+        noise, _ = signal.sosfilt(self.low_pass, self._raw_noise(block), zi=self.zi[block])
+        return noise
+
+    def _values(self, idx):
+        values = self.base[idx % len(self.base)] * self.scale
+        if self.drop_kernel is not None:
+            k = idx - self.drop_idx
+            in_drop = (k >= 0) & (k < len(self.drop_kernel))
+            values[in_drop] *= self.drop_kernel[k[in_drop]]
+        if self.noise_level:
+            blocks = idx // self.block_size
+            for block in np.unique(blocks):
+                in_block = blocks == block
+                values[in_block] += self._noise_block(block)[idx[in_block] - block*self.block_size] * self.noise_level
+        return values
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            return self._values(np.arange(*key.indices(len(self))))
+        idx = np.asarray(key)
+        if idx.dtype == bool:
+            return self._values(np.flatnonzero(idx))
+        if np.any((idx >= len(self)) | (idx < -len(self))):
+            raise IndexError('index out of range for TiledSignal of length %d' % len(self))
+        values = self._values(np.where(idx < 0, idx + len(self), idx))
+        return values if idx.ndim else values[()]
+
+    def __array__(self, dtype = None, copy = None):
+        values = self[:]
+        return values if dtype is None else values.astype(dtype)
+
+    def content_key(self):
+        '''
+        The parameters that define the samples, for memo.hash_key (and so sweepstore fingerprints)
+        '''
+        return (self.base, self.num_tiles, self.scale, self.drop_kernel, self.drop_idx, self.noise_level,
+                self.low_pass, self.noise_seed, self.block_size)
+
+
+@instrument
+def synthesize_SpO2_lazy(h, params, seed = None):
+    '''
+    synthesize_SpO2 without materializing the recording: red_AC, red_DC, IR_AC and IR_DC are TiledSignal objects
+    computed on demand from the tile_range segment, the drop kernel and the noise parameters, drawn from
+    np.random.default_rng(seed). red, IR, ratio, spo2 and time_min are not stored; getSpO2_windows (and so
+    test_data_rate) read the components directly, and getSpO2 still works but builds the full arrays.
+    The noise has the same statistics as in synthesize_SpO2 but is not the same random sequence.
+    '''
+    rng = np.random.default_rng(seed)
+    sampling_rate = h['sampling_rate']
+    tile_range = h['tile_range']
+
+    simulation_dur_sec = params['drop_time_sec'] + params['recover_time_sec'] + 20*60 # 20 minute buffer
+    data_dur_sec = (tile_range[1]-tile_range[0])/sampling_rate
+    num2tile = int(np.ceil(simulation_dur_sec/data_dur_sec))
+
+    # NB: as in synthesize_SpO2, IR is used to synthesize both red and IR
+    AC_base = np.asarray(h['IR_AC'][tile_range[0]:tile_range[1]], dtype=float)
+    DC_base = np.asarray(h['IR_DC'][tile_range[0]:tile_range[1]], dtype=float)
+
+    # 5-15 minutes into the recording = spo2 drop
+    drop_idx = int(rng.integers(int(5*60*sampling_rate), int(15*60*sampling_rate)))
+
+    synth_ratio = (params['baseline_spo2']-120)/-40
+    noise_level = params['noise'] * np.std(DC_base*synth_ratio) * 10 # the std of the tiled signal is that of one tile
+    low_pass  = filter_bank(sampling_rate).noise_low_pass
+    noise_seed = int(rng.integers(2**32))
+
+    data_synth = dict()
+    data_synth['red_AC'] = TiledSignal(AC_base, num2tile)
+    data_synth['red_DC'] = TiledSignal(DC_base, num2tile, drop_kernel=make_kernel(sampling_rate, params), drop_idx=drop_idx)
+    data_synth['IR_AC'] = data_synth['red_AC']
+    data_synth['IR_DC'] = TiledSignal(DC_base, num2tile, scale=synth_ratio, noise_level=noise_level, low_pass=low_pass, noise_seed=noise_seed)
+    data_synth['sampling_rate'] = sampling_rate
+    data_synth['drop_idx'] = drop_idx
+    data_synth['tile_range'] = tile_range
+    return data_synth
+
+
+@instrument
+def synthesize_SpO2_batch(h, params, num_realizations, seed = None):
+    '''
+    num_realizations independent runs of synthesize_SpO2 in one call, drawn from np.random.default_rng(seed) instead of
+    the global random state. The tiled signal is built once and shared by all realizations (read-only broadcast views
+    for the AC components); only the drop placement and the noise differ per realization.
+    Arrays are (num_realizations x samples) and drop_idx has one entry per realization; use get_realization for a
+    single synthesize_SpO2-style dict. red and IR are not stored (they are red_AC + red_DC and IR_AC + IR_DC), only
+    get_realization adds them for its row.
+    '''
+    rng = np.random.default_rng(seed)
+    sampling_rate = h['sampling_rate']
+    tile_range = h['tile_range']
+
+    simulation_dur_sec = params['drop_time_sec'] + params['recover_time_sec'] + 20*60 # 20 minute buffer
+    data_dur_sec = (tile_range[1]-tile_range[0])/sampling_rate
+    num2tile = int(np.ceil(simulation_dur_sec/data_dur_sec))
+
+    # NB: as in synthesize_SpO2, IR is used to synthesize both red and IR
+    AC_synth = np.tile(h['IR_AC'][tile_range[0]:tile_range[1]], num2tile)
+    DC_synth = np.tile(h['IR_DC'][tile_range[0]:tile_range[1]], num2tile)
+    N = len(AC_synth)
+    shape = (num_realizations, N)
+
+    # mimic spo2 drop on 'red' DC, 5-15 minutes into the recording
+    drop_kernel = make_kernel(sampling_rate, params)
+    drop_idx = rng.integers(int(5*60*sampling_rate), int(15*60*sampling_rate), size=num_realizations)
+    red_DC_synth = np.tile(DC_synth, (num_realizations, 1))
+    rows = np.arange(num_realizations)[:,None]
+    red_DC_synth[rows, drop_idx[:,None] + np.arange(len(drop_kernel))] *= drop_kernel
+
+    synth_ratio = (params['baseline_spo2']-120)/-40
+    IR_DC_synth = DC_synth*synth_ratio
+
+    # add noise
+    noise_level = params['noise'] * np.std(IR_DC_synth) * 10
+    noise = filter_bank(sampling_rate).noise(rng.standard_normal(shape), noise_level)
+    IR_DC_synth = IR_DC_synth + noise
+
+    AC_synth = np.broadcast_to(AC_synth, shape)
+    data_synth = dict()
+    data_synth['red_AC'] = AC_synth
+    data_synth['red_DC'] = red_DC_synth
+    data_synth['IR_AC'] = AC_synth
+    data_synth['IR_DC'] = IR_DC_synth
+    data_synth['sampling_rate'] = sampling_rate
+    data_synth['drop_idx'] = drop_idx
+    data_synth['time_min'] = np.linspace(0,N/sampling_rate,N)/60
+
+    data_synth = getSpO2(data_synth, tile_range)
+
+    return data_synth
+
+
+def get_realization(data_synth, i):
+    '''
+    Realization i of synthesize_SpO2_batch output, as a dict like the output of synthesize_SpO2
+    '''
+    h = dict()
+    for key in ['red_AC', 'red_DC', 'IR_AC', 'IR_DC', 'ratio', 'spo2', 'drop_idx']:
+        h[key] = data_synth[key][i]
+    h['red'] = h['red_AC'] + h['red_DC']
+    h['IR'] = h['IR_AC'] + h['IR_DC']
+    for key in ['sampling_rate', 'time_min', 'tile_range']:
+        h[key] = data_synth[key]
+    return h
+
 # function to synthesze a spo2 drop
 def make_kernel(sampling_rate, params):
 